@@ -0,0 +1,10 @@
+"""Benchmarks for PortfoHub.
+
+    python -m bench.generate --db /tmp/bench.db --users 2000 --items 50000
+    python -m bench.run --db /tmp/bench.db --mode client --save bench/baselines/client.json
+    python -m bench.run --db /tmp/bench.db --mode gunicorn --workers 4 --concurrency 16
+    python -m bench.compare bench/baselines/client.json /tmp/new.json
+
+Everything runs against a scratch database; its uploads, caches and logs go
+to a "<db name>_files" directory next to it, never into the real tree.
+"""
@@ -0,0 +1,57 @@
+"""Compare two saved bench.run results and flag regressions.
+
+    python -m bench.compare bench/baselines/client.json /tmp/new.json --threshold 10
+
+Exits with status 1 when any scenario's p95 grew by more than --threshold percent.
+"""
+import json
+
+import click
+
+METRICS = ("p50_ms", "p95_ms", "p99_ms", "throughput_rps")
+
+
+def change(old, new):
+    if not old:
+        return None
+    return (new - old) / old * 100
+
+
+@click.command()
+@click.argument("baseline", type=click.File())
+@click.argument("current", type=click.File())
+@click.option("--threshold", default=10.0, show_default=True, help="Allowed p95 slowdown in percent.")
+def compare(baseline, current, threshold):
+    """Show per-scenario changes from BASELINE to CURRENT."""
+    old = json.load(baseline)
+    new = json.load(current)
+    for key in ("mode", "users", "items", "concurrency"):
+        if old["meta"].get(key) != new["meta"].get(key):
+            click.echo(f"warning: {key} differs ({old['meta'].get(key)} vs {new['meta'].get(key)})", err=True)
+
+    click.echo(f"{'scenario':<16} " + " ".join(f"{metric:>22}" for metric in METRICS))
+    regressions = []
+    for name, before in old["scenarios"].items():
+        after = new["scenarios"].get(name)
+        if after is None:
+            click.echo(f"{name:<16} (missing from {current.name})")
+            continue
+        cells = []
+        for metric in METRICS:
+            delta = change(before[metric], after[metric])
+            delta_text = "" if delta is None else f"{delta:+.0f}%"
+            cells.append(f"{before[metric]:>8.1f} -> {after[metric]:>7.1f} {delta_text:>4}")
+        click.echo(f"{name:<16} " + " ".join(f"{cell:>22}" for cell in cells))
+        p95_change = change(before["p95_ms"], after["p95_ms"])
+        if p95_change is not None and p95_change > threshold:
+            regressions.append((name, p95_change))
+
+    if regressions:
+        for name, delta in regressions:
+            click.echo(f"REGRESSION {name}: p95 {delta:+.1f}%", err=True)
+        raise SystemExit(1)
+    click.echo("No p95 regressions above the threshold.")
+
+
+if __name__ == "__main__":
+    compare()
@@ -0,0 +1,259 @@
+"""Bulk-load a scratch database with synthetic users and portfolio items.
+
+    python -m bench.generate --db /tmp/bench.db --users 2000 --items 50000
+
+Rows go in with executemany, one transaction per --batch-size rows; tags,
+facets, the search index and upload reference counts are then derived with
+the app's own helpers, so the result looks like a database grown through the UI.
+"""
+import hashlib
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import click
+
+BENCH_PASSWORD = "bench-password"
+
+FIRST_NAMES = [
+    "Aziz", "Dilnoza", "Bekzod", "Malika", "Timur", "Nigora", "Olga", "Ivan", "Anna",
+    "Sardor", "Kamola", "Rustam", "Elena", "Jasur", "Madina", "Sergey", "Lola", "Otabek",
+]
+LAST_NAMES = [
+    "Karimov", "Usmonova", "Petrov", "Rakhimov", "Ivanova", "Tursunov", "Sokolova",
+    "Yusupov", "Nazarova", "Smirnov", "Alimov", "Kim", "Abdullaeva", "Orlov",
+]
+PROFESSIONS = ["Backend developer", "Designer", "Photographer", "Data analyst", "Illustrator", "Frontend developer"]
+# Listed most popular first; items pick from the front more often.
+CATEGORIES = ["Code", "Design", "Photography", "Illustration", "Web", "Mobile", "Data", "Video", "Writing", "3D", "Music", "Other"]
+TAGS = [
+    "python", "javascript", "react", "flask", "django", "figma", "ui", "ux", "branding", "logo",
+    "portrait", "landscape", "sql", "sqlite", "postgres", "docker", "linux", "go", "rust", "kotlin",
+    "swift", "android", "ios", "typescript", "vue", "svelte", "css", "html", "animation", "blender",
+    "unity", "pandas", "ml", "nlp", "api", "rest", "graphql", "testing", "ci", "aws",
+    "tashkent", "samarkand", "bukhara", "startup", "hackathon", "opensource", "freelance", "poster", "print", "typography",
+]
+WORDS = (
+    "fast simple modern clean responsive accessible minimal bold colorful open "
+    "portfolio project app site dashboard service library tool game shop blog "
+    "design system pipeline model study poster album gallery landing engine "
+    "built with using for the and a of in on to across small large city local "
+    "team client community course personal weekly data image search feed profile"
+).split()
+
+
+def skewed(seq, power=2.0):
+    """An element of seq, earlier ones much more likely."""
+    return seq[int(len(seq) * random.random() ** power)]
+
+
+def solid_png(width, height, rgb):
+    """A valid PNG of one colour, made without Pillow."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    row = b"\x00" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+
+def scratch_env(db_path):
+    """Environment that points the app at a scratch database and its own files."""
+    db_path = os.path.abspath(db_path)
+    files = os.path.splitext(db_path)[0] + "_files"
+    return {
+        "DATABASE_PATH": db_path,
+        "UPLOAD_FOLDER": os.path.join(files, "uploads"),
+        "FEED_CACHE_PATH": os.path.join(files, "cache.db"),
+        "METRICS_DIR": os.path.join(files, "metrics"),
+        "SLOW_QUERY_LOG": os.path.join(files, "slow_queries.jsonl"),
+        "PROFILE_DIR": os.path.join(files, "profiles"),
+    }
+
+
+def load_app(db_path):
+    """Import main against the scratch database (it must not be imported before)."""
+    if "main" in sys.modules:
+        raise RuntimeError("main was already imported against another database")
+    os.environ.update(scratch_env(db_path))
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+    return main
+
+
+def sentence(min_words, max_words):
+    return " ".join(random.choice(WORDS) for _ in range(random.randint(min_words, max_words))).capitalize()
+
+
+def generate_images(main, count):
+    """Store `count` distinct PNGs as content-addressed uploads; returns {filename: size}."""
+    images = {}
+    for i in range(count):
+        data = solid_png(64 + i % 7 * 16, 48 + i % 5 * 12, (i * 37 % 256, i * 91 % 256, i * 53 % 256))
+        filename = f"{hashlib.sha256(data).hexdigest()}.png"
+        path = main.upload_path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        images[filename] = len(data)
+    return images
+
+
+def user_rows(count, images, password_hash, start):
+    names = list(images)
+    for i in range(1, count + 1):
+        full_name = f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}"
+        joined = (start + timedelta(seconds=random.randint(0, 30 * 86400))).isoformat()
+        yield (
+            full_name,
+            f"user{i:06d}",
+            f"user{i:06d}@bench.example",
+            password_hash,
+            sentence(5, 25),
+            random.choice(["Tashkent", "Samarkand", "Bukhara", "Moscow", ""]),
+            random.choice(PROFESSIONS),
+            random.choice(names) if names and random.random() < 0.5 else None,
+            joined,
+            joined,
+        )
+
+
+def item_rows(main, count, users, images, start):
+    names = list(images)
+    for _ in range(count):
+        created = start + timedelta(seconds=random.randint(30 * 86400, 365 * 86400))
+        tags = sorted({skewed(TAGS) for _ in range(random.randint(0, 5))})
+        description = sentence(20, 120)
+        yield (
+            # A few prolific users own most items, like on the real site.
+            1 + int(users * random.random() ** 3),
+            sentence(2, 6),
+            description,
+            main.description_excerpt(description),
+            skewed(CATEGORIES, 1.5),
+            ", ".join(tags),
+            "https://example.com/" + random.choice(WORDS) if random.random() < 0.3 else "",
+            random.choice(names) if names and random.random() < 0.6 else None,
+            "public" if random.random() < 0.85 else "private",
+            created.isoformat(),
+            created.isoformat(),
+        )
+
+
+def insert_batches(main, sql, rows, batch_size, label):
+    batch = []
+    done = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            with main.write_transaction() as db:
+                db.executemany(sql, batch)
+            done += len(batch)
+            batch = []
+            click.echo(f"  {label}: {done}", err=True)
+    if batch:
+        with main.write_transaction() as db:
+            db.executemany(sql, batch)
+        done += len(batch)
+    return done
+
+
+@click.command()
+@click.option("--db", "db_path", required=True, help="Scratch database file to create.")
+@click.option("--users", default=1000, show_default=True)
+@click.option("--items", default=20000, show_default=True)
+@click.option("--images", default=50, show_default=True, help="Distinct image files to reference.")
+@click.option("--batch-size", default=5000, show_default=True, help="Rows per transaction.")
+@click.option("--seed", default=1, show_default=True)
+@click.option("--force", is_flag=True, help="Replace an existing scratch database.")
+def generate(db_path, users, items, images, batch_size, seed, force):
+    """Create a scratch database with USERS users and ITEMS portfolio items."""
+    if os.path.exists(db_path):
+        if not force:
+            raise click.UsageError(f"{db_path} exists; pass --force to replace it.")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+    random.seed(seed)
+    main = load_app(db_path)
+    from werkzeug.security import generate_password_hash
+
+    started = time.perf_counter()
+    start = datetime.utcnow() - timedelta(days=400)
+    with main.app.app_context():
+        image_sizes = generate_images(main, images)
+        insert_batches(
+            main,
+            """
+            INSERT INTO users
+            (full_name, username, email, password_hash, bio, location, profession, avatar_filename,
+             created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            user_rows(users, image_sizes, generate_password_hash(BENCH_PASSWORD), start),
+            batch_size,
+            "users",
+        )
+        insert_batches(
+            main,
+            """
+            INSERT INTO portfolio_items
+            (user_id, title, description, description_excerpt, category, tags, external_link,
+             image_filename, visibility, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            item_rows(main, items, users, image_sizes, start),
+            batch_size,
+            "items",
+        )
+
+        click.echo("Deriving tags, facets, search index and upload references...", err=True)
+        db = main.get_db()
+        last_id = 0
+        while True:
+            rows = db.execute(
+                "SELECT id, tags FROM portfolio_items WHERE id > ? AND tags != '' ORDER BY id LIMIT ?",
+                (last_id, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+            with main.write_transaction() as db:
+                for row in rows:
+                    main.set_item_tags(db, row["id"], row["tags"])
+            last_id = rows[-1]["id"]
+        with main.write_transaction() as db:
+            if main.HAS_FTS5:
+                main.rebuild_search_index(db)
+            main.rebuild_facets(db)
+            db.executemany(
+                """
+                INSERT INTO upload_blobs (filename, sha256, size, refcount, created_at)
+                SELECT ?1, ?2, ?3, COUNT(*), ?4 FROM (
+                    SELECT 1 FROM users WHERE avatar_filename = ?1
+                    UNION ALL
+                    SELECT 1 FROM portfolio_items WHERE image_filename = ?1
+                )
+                """,
+                [
+                    (name, name.split(".")[0], size, datetime.utcnow().isoformat())
+                    for name, size in image_sizes.items()
+                ],
+            )
+            main.bump_data_generation(db)
+        db.execute("ANALYZE")
+    click.echo(
+        f"Created {users} users and {items} items in {db_path} "
+        f"({time.perf_counter() - started:.1f}s). Password for every user: {BENCH_PASSWORD}"
+    )
+
+
+if __name__ == "__main__":
+    generate()
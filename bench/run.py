@@ -0,0 +1,418 @@
+"""Run request scenarios against a scratch database and report latency percentiles.
+
+    python -m bench.run --db /tmp/bench.db --mode client --requests 500
+    python -m bench.run --db /tmp/bench.db --mode gunicorn --workers 4 --concurrency 16 --save out.json
+
+"client" drives the app in-process through Flask's test client, which shows
+the cost of our own code; "gunicorn" starts a local gunicorn on the same
+database and talks HTTP to it, which adds the server, sockets and workers.
+"""
+import http.cookiejar
+import io
+import json
+import os
+import platform
+import random
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from uuid import uuid4
+
+import click
+
+from bench.generate import BENCH_PASSWORD, CATEGORIES, TAGS, WORDS, load_app, scratch_env, solid_png
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CSRF_INPUT = re.compile(rb'name="csrf_token" value="([^"]+)"')
+NEXT_CURSOR = re.compile(rb'[?&;]after=([A-Za-z0-9_%=-]+)')
+
+
+# --- SESSIONS ---
+
+class ClientSession:
+    """One browser-like session on the in-process test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get_data()
+
+    def post(self, path, fields, files=None):
+        data = dict(fields)
+        for name, (filename, content) in (files or {}).items():
+            data[name] = (io.BytesIO(content), filename)
+        response = self.client.post(path, data=data, content_type="multipart/form-data")
+        return response.status_code, response.get_data()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # A redirect is the answer we time, not a second request.
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def encode_multipart(fields, files):
+    boundary = uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n".encode()
+            + content
+            + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class HTTPSession:
+    """One browser-like session (its own cookies) against a running server."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect()
+        )
+
+    def _open(self, request):
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read()
+
+    def get(self, path):
+        return self._open(urllib.request.Request(self.base_url + path))
+
+    def post(self, path, fields, files=None):
+        body, content_type = encode_multipart(fields, files or {})
+        return self._open(
+            urllib.request.Request(self.base_url + path, data=body, headers={"Content-Type": content_type})
+        )
+
+
+# --- SCENARIOS ---
+
+class Context:
+    """Per-session state shared by the scenario steps."""
+
+    def __init__(self, make_session, usernames, rng):
+        self.make_session = make_session
+        self.session = make_session()
+        self.usernames = usernames
+        self.rng = rng
+        self.cursor = None
+        self.page = 0
+        self.own_items = []
+        self.token = None
+
+    def csrf_token(self, path="/portfolio/new"):
+        status, body = self.session.get(path)
+        match = CSRF_INPUT.search(body)
+        if match is None:
+            raise RuntimeError(f"No CSRF token on {path} (status {status})")
+        return match.group(1).decode()
+
+    def login(self):
+        token = self.csrf_token("/login")
+        username = self.rng.choice(self.usernames)
+        status, _ = self.session.post("/login", {"csrf_token": token, "username": username, "password": BENCH_PASSWORD})
+        if status != 302:
+            raise RuntimeError(f"Login as {username} failed with {status}")
+        return username
+
+    def item_fields(self):
+        return {
+            "csrf_token": self.token,
+            "title": " ".join(self.rng.choice(WORDS) for _ in range(4)).capitalize(),
+            "description": " ".join(self.rng.choice(WORDS) for _ in range(60)),
+            "category": self.rng.choice(CATEGORIES),
+            "tags": ", ".join(self.rng.sample(TAGS, 3)),
+            "visibility": "public",
+        }
+
+
+def step_feed(ctx):
+    return ctx.session.get("/")
+
+
+def step_deep_pagination(ctx, depth=25):
+    """Walk the feed page by page; each call fetches the next page, restarting after `depth`."""
+    path = "/" if ctx.cursor is None else f"/?after={ctx.cursor}"
+    status, body = ctx.session.get(path)
+    match = NEXT_CURSOR.search(body)
+    ctx.page += 1
+    if match is None or ctx.page >= depth:
+        ctx.cursor, ctx.page = None, 0
+    else:
+        ctx.cursor = match.group(1).decode()
+    return status, body
+
+
+def step_search(ctx):
+    return ctx.session.get(f"/?q={ctx.rng.choice(WORDS + TAGS)}")
+
+
+def step_category(ctx):
+    return ctx.session.get(f"/?category={ctx.rng.choice(CATEGORIES)}")
+
+
+def step_tag(ctx):
+    return ctx.session.get(f"/?tag={ctx.rng.choice(TAGS)}")
+
+
+def step_public_profile(ctx):
+    # Low user ids own the most items, so this mixes heavy and light profiles.
+    return ctx.session.get(f"/u/{ctx.rng.choice(ctx.usernames)}")
+
+
+def before_login(ctx):
+    # A logged-in session would just be redirected, so every attempt starts anonymous.
+    ctx.session = ctx.make_session()
+    ctx.token = ctx.csrf_token("/login")
+
+
+def step_login(ctx):
+    status, body = ctx.session.post(
+        "/login",
+        {"csrf_token": ctx.token, "username": ctx.rng.choice(ctx.usernames), "password": BENCH_PASSWORD},
+    )
+    if status != 302:
+        # A wrong password re-renders the form with 200; that is not a login.
+        raise RuntimeError(f"Login failed with {status}")
+    return status, body
+
+
+def step_create(ctx):
+    return ctx.session.post("/portfolio/new", ctx.item_fields())
+
+
+def step_edit(ctx):
+    item_id = ctx.rng.choice(ctx.own_items)
+    return ctx.session.post(f"/portfolio/{item_id}/edit", ctx.item_fields())
+
+
+def step_upload(ctx):
+    # New bytes every time, so the upload is really stored and not deduplicated.
+    image = solid_png(320, 240, (ctx.rng.randrange(256), ctx.rng.randrange(256), ctx.rng.randrange(256)))
+    image += uuid4().bytes  # trailing bytes after IEND are ignored by decoders
+    return ctx.session.post("/portfolio/new", ctx.item_fields(), {"image": ("bench.png", image)})
+
+
+# name -> (step, needs a logged-in session, untimed setup before every step)
+SCENARIOS = {
+    "feed": (step_feed, False, None),
+    "deep_pagination": (step_deep_pagination, False, None),
+    "search": (step_search, False, None),
+    "category": (step_category, False, None),
+    "tag": (step_tag, False, None),
+    "public_profile": (step_public_profile, False, None),
+    "login": (step_login, False, before_login),
+    "create": (step_create, True, None),
+    "edit": (step_edit, True, None),
+    "upload": (step_upload, True, None),
+}
+
+
+def prepare(ctx, name, db_path):
+    """Log in and fetch what a scenario needs before it is timed."""
+    ctx.token = ctx.csrf_token("/login")
+    if not SCENARIOS[name][1]:
+        return
+    username = ctx.login()
+    ctx.token = ctx.csrf_token()
+    if name == "edit":
+        ctx.session.post("/portfolio/new", ctx.item_fields())
+        with sqlite3.connect(db_path) as conn:
+            ctx.own_items = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT p.id FROM portfolio_items p JOIN users u ON u.id = p.user_id WHERE u.username = ? LIMIT 50",
+                    (username,),
+                )
+            ]
+
+
+# --- RUNNER ---
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(name, make_session, usernames, db_path, requests, concurrency, warmup, seed):
+    step, _, before = SCENARIOS[name]
+    contexts = []
+    for i in range(concurrency):
+        ctx = Context(make_session, usernames, random.Random(seed * 1000 + i))
+        prepare(ctx, name, db_path)
+        contexts.append(ctx)
+    for i in range(warmup):
+        ctx = contexts[i % concurrency]
+        if before is not None:
+            before(ctx)
+        step(ctx)
+
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    per_worker = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+
+    def worker(ctx, count):
+        nonlocal errors
+        for _ in range(count):
+            if before is not None:
+                before(ctx)
+            start = time.perf_counter()
+            try:
+                status, _ = step(ctx)
+            except Exception:
+                status = 599
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker, ctx, count) for ctx, count in zip(contexts, per_worker)]:
+            future.result()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ms = [value * 1000 for value in latencies]
+    return {
+        "count": len(ms),
+        "errors": errors,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "mean_ms": round(sum(ms) / len(ms), 3),
+        "throughput_rps": round(len(ms) / wall, 1),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(db_path, workers, threads):
+    port = free_port()
+    env = dict(os.environ, **scratch_env(db_path))
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "gunicorn",
+            "--workers", str(workers), "--threads", str(threads),
+            "--bind", f"127.0.0.1:{port}", "--chdir", REPO_DIR, "--log-level", "warning",
+            "main:app",
+        ],
+        env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise click.ClickException("gunicorn exited during startup")
+        try:
+            urllib.request.urlopen(base_url + "/", timeout=1).close()
+            return process, base_url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise click.ClickException("gunicorn did not start listening within 30s")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option("--db", "db_path", required=True, help="Scratch database made by bench.generate.")
+@click.option("--mode", type=click.Choice(["client", "gunicorn"]), default="client", show_default=True)
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(list(SCENARIOS)),
+              help="Scenario to run (repeatable); default all.")
+@click.option("--requests", default=300, show_default=True, help="Timed requests per scenario.")
+@click.option("--concurrency", default=1, show_default=True, help="Parallel sessions.")
+@click.option("--warmup", default=20, show_default=True, help="Untimed requests per scenario.")
+@click.option("--workers", default=2, show_default=True, help="gunicorn workers (gunicorn mode).")
+@click.option("--threads", default=4, show_default=True, help="gunicorn threads per worker.")
+@click.option("--seed", default=1, show_default=True)
+@click.option("--save", type=click.Path(dir_okay=False), help="Write the results as a JSON baseline.")
+def run(db_path, mode, scenarios, requests, concurrency, warmup, workers, threads, seed, save):
+    """Run the scenarios and print p50/p95/p99 latency and throughput."""
+    if not os.path.exists(db_path):
+        raise click.UsageError(f"{db_path} does not exist; create it with python -m bench.generate")
+    with sqlite3.connect(db_path) as conn:
+        usernames = [row[0] for row in conn.execute("SELECT username FROM users WHERE username LIKE 'user%'")]
+        counts = conn.execute("SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM portfolio_items)").fetchone()
+
+    process = None
+    if mode == "client":
+        app = load_app(db_path).app
+        make_session = partial(ClientSession, app)
+    else:
+        process, base_url = start_gunicorn(db_path, workers, threads)
+        make_session = partial(HTTPSession, base_url)
+
+    results = {}
+    try:
+        click.echo(f"{'scenario':<16} {'n':>6} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8}")
+        for name in scenarios or SCENARIOS:
+            stats = run_scenario(name, make_session, usernames, db_path, requests, concurrency, warmup, seed)
+            results[name] = stats
+            click.echo(
+                f"{name:<16} {stats['count']:>6} {stats['errors']:>4} {stats['p50_ms']:>9.2f} "
+                f"{stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['throughput_rps']:>8.1f}"
+            )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    if save:
+        report = {
+            "meta": {
+                "created_at": datetime.utcnow().isoformat(),
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "mode": mode,
+                "users": counts[0],
+                "items": counts[1],
+                "requests": requests,
+                "concurrency": concurrency,
+                "workers": workers if mode == "gunicorn" else None,
+                "threads": threads if mode == "gunicorn" else None,
+            },
+            "scenarios": results,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(save)), exist_ok=True)
+        with open(save, "w") as f:
+            json.dump(report, f, indent=2)
+        click.echo(f"Saved {save}")
+
+
+if __name__ == "__main__":
+    run()
@@ -1,22 +1,80 @@
+import base64
+import cProfile
+import hashlib
+import hmac
+import json
+import mimetypes
 import os
+import pstats
+import queue
+import random
+import re
+import shutil
+import signal
 import sqlite3
-from datetime import datetime, timedelta
-from functools import wraps
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from itertools import islice
+from types import MappingProxyType
+from urllib.parse import quote
 from uuid import uuid4
 
+import click
 from flask import (
-    Flask, render_template, request, redirect,
-    url_for, flash, session, g, abort, send_from_directory
+    Flask, Request, Response, render_template, request, redirect,
+    url_for, flash, session, g, abort, send_from_directory, jsonify,
+    has_request_context, before_render_template, template_rendered,
+    get_template_attribute
 )
+from flask.cli import AppGroup
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 
+try:
+    import fcntl
+except ImportError:  # not on Windows; metrics aggregation then runs unlocked
+    fcntl = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it only originals are served
+    Image = None
+
 # --- CONFIGURATION ---
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-DB_PATH = os.path.join(BASE_DIR, "database.db")
-UPLOAD_FOLDER = os.path.join("static", "uploads")
+# Both can point elsewhere, e.g. at a scratch copy for bench/
+DB_PATH = os.environ.get("DATABASE_PATH", os.path.join(BASE_DIR, "database.db"))
+UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", os.path.join("static", "uploads"))
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Uploads are stored as <sha256><ext>; older uploads keep <name>_<uuid4><ext>.
+CONTENT_ADDRESSED_NAME = re.compile(r"^([0-9a-f]{64})\.[a-z0-9]+$")
+# Content-addressed uploads and their variants (<sha256>_card.jpg ...) start with the hash.
+HASH_PREFIXED_NAME = re.compile(r"^[0-9a-f]{64}")
+FEED_PER_PAGE = 9
+
+# Resized derivatives made for every uploaded image: name -> bounding box.
+# Listed smallest first, which is the order they appear in srcset.
+IMAGE_VARIANTS = {
+    "avatar": (192, 192),
+    "hero": (320, 240),
+    "card": (720, 540),
+}
+ITEM_IMAGE_VARIANTS = ("hero", "card")
+AVATAR_IMAGE_VARIANTS = ("avatar",)
+PROFILE_PER_PAGE = 12
+# Characters of a description kept in description_excerpt for listing cards
+EXCERPT_LENGTH = 220
 
 app = Flask(__name__)
 # --- LANGUAGES / I18N ---
@@ -27,432 +85,3223 @@ LANGUAGES = {
     "ru": {"label": "Русский"},
 }
 
-translations = {
-    "en": {
-        "app_name": "PortfoHub",
-        "nav_home": "Home",
-        "nav_my_profile": "My profile",
-        "nav_create": "Create portfolio",
-        "nav_settings": "Settings",
-        "nav_login": "Login",
-        "nav_register": "Register",
-        "nav_logout": "Logout",
-
-        "hero_kicker": "Portfolio social network",
-        "hero_title": "Show your best work",
-        "hero_subtitle": "Create a profile, upload your projects, and share a clean, professional portfolio – all in one simple, responsive web app.",
-        "hero_cta_main_logged_out": "Get started – it’s free",
-        "hero_cta_secondary_logged_out": "I already have an account",
-        "hero_cta_main_logged_in": "+ New portfolio item",
-        "hero_cta_secondary_logged_in": "Go to my profile",
-
-        "section_public_feed_title": "Public feed",
-        "section_public_feed_subtitle": "Browse portfolios from all users",
-        "search_placeholder": "Search by name, username, title, or tags...",
-        "filter_all_categories": "All categories",
-        "btn_filter": "Filter",
-        "btn_view_profile": "View profile",
-        "text_no_portfolios": "No public portfolios found yet.",
-        "text_create_account_cta": "Create your account",
-
-        "auth_register_title": "Create your account",
-        "auth_login_title": "Log in",
-        "auth_register_button": "Register",
-        "auth_login_button": "Login",
-        "label_full_name": "Full name",
-        "label_username": "Username",
-        "label_email": "Email address",
-        "label_password": "Password",
-        "label_confirm_password": "Confirm password",
-        "label_username_or_email": "Username or email",
-        "label_remember_me": "Remember me",
-        "auth_already_account": "Already have an account?",
-        "auth_login_here": "Log in",
-        "auth_new_here": "New here?",
-        "auth_create_here": "Create an account",
-
-        "settings_title": "Profile settings",
-        "label_profession": "Profession / specialization",
-        "label_location": "Location",
-        "label_bio": "Short bio",
-        "label_website": "Website",
-        "label_linkedin": "LinkedIn",
-        "label_github": "GitHub",
-        "label_avatar": "Profile photo (avatar)",
-        "btn_save_changes": "Save changes",
-        "settings_privacy_note": "Privacy note: only your public portfolio items are visible on the homepage and to other users. Private items are visible only to you.",
-
-        "profile_about_section_label": "About me",
-        "profile_about_section_title": "Personal profile",
-        "profile_portfolio_section_label": "Portfolio",
-        "profile_portfolio_section_title": "My work",
-        "profile_stats_items": "Portfolio items",
-        "profile_stats_focus": "Professional focus",
-        "profile_no_items": "You have no portfolio items yet.",
-        "profile_create_first": "Create your first one.",
-        "btn_edit_profile": "Edit profile",
-        "btn_public_view": "View public profile",
-        "btn_new_portfolio": "+ New portfolio",
-        "btn_view_link": "View link",
-        "btn_edit": "Edit",
-        "btn_delete": "Delete",
-
-        "public_about_label": "About",
-        "public_about_title": "Professional profile",
-        "public_portfolio_label": "Portfolio",
-        "public_portfolio_title": "Selected work",
-        "public_no_items": "No public portfolio items yet.",
-    },
-
-    "uz": {
-        "app_name": "PortfoHub",
-        "nav_home": "Bosh sahifa",
-        "nav_my_profile": "Profilim",
-        "nav_create": "Portfolio qo‘shish",
-        "nav_settings": "Sozlamalar",
-        "nav_login": "Kirish",
-        "nav_register": "Ro‘yxatdan o‘tish",
-        "nav_logout": "Chiqish",
-
-        "hero_kicker": "Portfolio tarmog‘i",
-        "hero_title": "Eng yaxshi ishlaringizni ko‘rsating",
-        "hero_subtitle": "Profil yarating, loyihalaringizni yuklang va zamonaviy, qulay portfolio bilan bo‘lishing.",
-        "hero_cta_main_logged_out": "Boshlash – bepul",
-        "hero_cta_secondary_logged_out": "Menda allaqachon akkaunt bor",
-        "hero_cta_main_logged_in": "Yangi portfolio qo‘shish",
-        "hero_cta_secondary_logged_in": "Profilimga o‘tish",
-
-        "section_public_feed_title": "Ochiq feed",
-        "section_public_feed_subtitle": "Barcha foydalanuvchilar portfoliolarini ko‘ring",
-        "search_placeholder": "Ism, username, sarlavha yoki teglar bo‘yicha qidirish...",
-        "filter_all_categories": "Barcha kategoriyalar",
-        "btn_filter": "Filtrlash",
-        "btn_view_profile": "Profilni ko‘rish",
-        "text_no_portfolios": "Hozircha ochiq portfoliolar topilmadi.",
-        "text_create_account_cta": "Akkaunt yarating",
-
-        "auth_register_title": "Akkaunt yaratish",
-        "auth_login_title": "Tizimga kirish",
-        "auth_register_button": "Ro‘yxatdan o‘tish",
-        "auth_login_button": "Kirish",
-        "label_full_name": "To‘liq ism",
-        "label_username": "Foydalanuvchi nomi",
-        "label_email": "Email manzil",
-        "label_password": "Parol",
-        "label_confirm_password": "Parolni tasdiqlash",
-        "label_username_or_email": "Foydalanuvchi nomi yoki email",
-        "label_remember_me": "Eslab qolish",
-        "auth_already_account": "Akkauntingiz bormi?",
-        "auth_login_here": "Bu yerda kiring",
-        "auth_new_here": "Yangi foydalanuvchimisiz?",
-        "auth_create_here": "Akkaunt yarating",
-
-        "settings_title": "Profil sozlamalari",
-        "label_profession": "Kasb / mutaxassislik",
-        "label_location": "Joylashuv",
-        "label_bio": "Qisqa bio",
-        "label_website": "Veb-sayt",
-        "label_linkedin": "LinkedIn",
-        "label_github": "GitHub",
-        "label_avatar": "Profil rasmi (avatar)",
-        "btn_save_changes": "O‘zgarishlarni saqlash",
-        "settings_privacy_note": "Maxfiylik: faqat public bo‘lgan portfoliolar bosh sahifada ko‘rinadi. Private portfoliolarni faqat siz ko‘rasiz.",
-
-        "profile_about_section_label": "Men haqimda",
-        "profile_about_section_title": "Shaxsiy profil",
-        "profile_portfolio_section_label": "Portfolio",
-        "profile_portfolio_section_title": "Mening ishlarim",
-        "profile_stats_items": "Portfolio elementlari",
-        "profile_stats_focus": "Kasbiy yo‘nalish",
-        "profile_no_items": "Hozircha portfoliolar kiritilmagan.",
-        "profile_create_first": "Birinchi portfolioingizni yarating.",
-        "btn_edit_profile": "Profilni tahrirlash",
-        "btn_public_view": "Ommaviy ko‘rinish",
-        "btn_new_portfolio": "Yangi portfolio",
-        "btn_view_link": "Havolani ochish",
-        "btn_edit": "Tahrirlash",
-        "btn_delete": "O‘chirish",
-
-        "public_about_label": "Haqida",
-        "public_about_title": "Kasbiy profil",
-        "public_portfolio_label": "Portfolio",
-        "public_portfolio_title": "Tanlangan ishlar",
-        "public_no_items": "Ommaviy portfoliolar yo‘q.",
-    },
-
-    "ru": {
-        "app_name": "PortfoHub",
-        "nav_home": "Главная",
-        "nav_my_profile": "Мой профиль",
-        "nav_create": "Добавить портфолио",
-        "nav_settings": "Настройки",
-        "nav_login": "Войти",
-        "nav_register": "Регистрация",
-        "nav_logout": "Выйти",
-
-        "hero_kicker": "Социальная сеть портфолио",
-        "hero_title": "Покажите свои лучшие работы",
-        "hero_subtitle": "Создайте профиль, загрузите проекты и делитесь аккуратным профессиональным портфолио в одном простом приложении.",
-        "hero_cta_main_logged_out": "Начать — это бесплатно",
-        "hero_cta_secondary_logged_out": "У меня уже есть аккаунт",
-        "hero_cta_main_logged_in": "Новое портфолио",
-        "hero_cta_secondary_logged_in": "Перейти в профиль",
-
-        "section_public_feed_title": "Лента",
-        "section_public_feed_subtitle": "Просматривайте портфолио всех пользователей",
-        "search_placeholder": "Поиск по имени, нику, заголовку или тегам...",
-        "filter_all_categories": "Все категории",
-        "btn_filter": "Фильтр",
-        "btn_view_profile": "Открыть профиль",
-        "text_no_portfolios": "Публичные портфолио пока не найдены.",
-        "text_create_account_cta": "Создать аккаунт",
-
-        "auth_register_title": "Создание аккаунта",
-        "auth_login_title": "Вход",
-        "auth_register_button": "Зарегистрироваться",
-        "auth_login_button": "Войти",
-        "label_full_name": "Полное имя",
-        "label_username": "Имя пользователя",
-        "label_email": "E-mail",
-        "label_password": "Пароль",
-        "label_confirm_password": "Подтверждение пароля",
-        "label_username_or_email": "Логин или e-mail",
-        "label_remember_me": "Запомнить меня",
-        "auth_already_account": "Уже есть аккаунт?",
-        "auth_login_here": "Войти",
-        "auth_new_here": "Впервые здесь?",
-        "auth_create_here": "Создать аккаунт",
-
-        "settings_title": "Настройки профиля",
-        "label_profession": "Профессия / специализация",
-        "label_location": "Местоположение",
-        "label_bio": "Краткая биография",
-        "label_website": "Веб-сайт",
-        "label_linkedin": "LinkedIn",
-        "label_github": "GitHub",
-        "label_avatar": "Фото профиля (аватар)",
-        "btn_save_changes": "Сохранить изменения",
-        "settings_privacy_note": "Конфиденциальность: только публичные портфолио видны на главной странице. Приватные портфолио видите только вы.",
-
-        "profile_about_section_label": "Обо мне",
-        "profile_about_section_title": "Личный профиль",
-        "profile_portfolio_section_label": "Портфолио",
-        "profile_portfolio_section_title": "Мои работы",
-        "profile_stats_items": "Элементов портфолио",
-        "profile_stats_focus": "Профессиональный фокус",
-        "profile_no_items": "У вас пока нет портфолио.",
-        "profile_create_first": "Создайте свою первую работу.",
-        "btn_edit_profile": "Редактировать профиль",
-        "btn_public_view": "Публичный вид",
-        "btn_new_portfolio": "Новое портфолио",
-        "btn_view_link": "Открыть ссылку",
-        "btn_edit": "Редактировать",
-        "btn_delete": "Удалить",
-
-        "public_about_label": "О пользователе",
-        "public_about_title": "Профессиональный профиль",
-        "public_portfolio_label": "Портфолио",
-        "public_portfolio_title": "Выбранные работы",
-        "public_no_items": "Публичных работ пока нет.",
-    },
-}
+TRANSLATIONS_DIR = os.path.join(BASE_DIR, "translations")
+DEFAULT_LANGUAGE = "en"
+
+
+def read_catalog_file(lang: str) -> dict:
+    path = os.path.join(TRANSLATIONS_DIR, f"{lang}.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@lru_cache(maxsize=None)
+def load_catalog(lang: str) -> MappingProxyType:
+    """Flat, read-only table for `lang`, with English merged underneath.
+
+    Built on first use per worker, so a missing key costs nothing at lookup time.
+    """
+    catalog = dict(read_catalog_file(DEFAULT_LANGUAGE))
+    if lang != DEFAULT_LANGUAGE:
+        catalog.update(read_catalog_file(lang))
+    return MappingProxyType(catalog)
+
+
+@lru_cache(maxsize=None)
+def translator(lang: str):
+    """gettext-style callable for one language; unknown keys come back as-is."""
+    lookup = load_catalog(lang).get
+
+    def translate(key: str) -> str:
+        return lookup(key, key)
+
+    return translate
+
+
+def get_locale():
+    if has_request_context():
+        code = g.get("locale")
+        if code is None:
+            code = session.get("lang", DEFAULT_LANGUAGE)
+            if code not in LANGUAGES:
+                code = DEFAULT_LANGUAGE
+            g.locale = code
+        return code
+    return DEFAULT_LANGUAGE
+
+
+def t(key: str) -> str:
+    return translator(get_locale())(key)
+
+
+i18n_cli = AppGroup("i18n", help="Translation catalog commands.")
+
+TEMPLATE_KEY = re.compile(r"""\bt\(\s*["']([A-Za-z0-9_]+)["']\s*\)""")
+
+
+@i18n_cli.command("check")
+def i18n_check_command():
+    """Report keys missing from (or unknown to) each catalog in LANGUAGES."""
+    used = set()
+    for root, _, files in os.walk(os.path.join(BASE_DIR, "templates")):
+        for name in files:
+            with open(os.path.join(root, name), encoding="utf-8") as f:
+                used.update(TEMPLATE_KEY.findall(f.read()))
+
+    reference = read_catalog_file(DEFAULT_LANGUAGE)
+    problems = 0
+    for key in sorted(used - set(reference)):
+        click.echo(f"{DEFAULT_LANGUAGE}: used in templates but missing: {key}")
+        problems += 1
+    for lang in LANGUAGES:
+        if lang == DEFAULT_LANGUAGE:
+            continue
+        catalog = read_catalog_file(lang)
+        if not catalog:
+            click.echo(f"{lang}: no catalog at translations/{lang}.json")
+            problems += 1
+            continue
+        for key in sorted(set(reference) - set(catalog)):
+            click.echo(f"{lang}: missing {key} (falls back to English)")
+            problems += 1
+        for key in sorted(set(catalog) - set(reference)):
+            click.echo(f"{lang}: unknown key {key}")
+            problems += 1
+    if problems:
+        raise SystemExit(f"{problems} translation problem(s).")
+    click.echo(f"All {len(LANGUAGES)} catalogs cover {len(reference)} keys.")
+
+
+app.cli.add_command(i18n_cli)
+
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret-key-change-me")
+app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = 2 * 1024 * 1024  # 2 MB
+# Run pending schema migrations at startup; set to 0 to use `flask db upgrade` instead.
+app.config["AUTO_MIGRATE"] = os.environ.get("AUTO_MIGRATE", "1") != "0"
+# SQLite connection pool (per worker process) and per-connection tuning
+app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", 8))
+app.config["DB_CACHE_SIZE_KB"] = int(os.environ.get("DB_CACHE_SIZE_KB", 16 * 1024))
+app.config["DB_MMAP_SIZE"] = int(os.environ.get("DB_MMAP_SIZE", 128 * 1024 * 1024))
+app.config["DB_BUSY_TIMEOUT_MS"] = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+app.config["DB_READ_POOL_SIZE"] = int(os.environ.get("DB_READ_POOL_SIZE", 8))
+# Extra attempts to take the write lock after busy_timeout has run out
+app.config["DB_WRITE_RETRIES"] = int(os.environ.get("DB_WRITE_RETRIES", 3))
+# Cross-request cache of user rows, per worker; size 0 disables it
+app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", 1024))
+app.config["USER_CACHE_TTL"] = float(os.environ.get("USER_CACHE_TTL", 60))
+# Public feed result cache: "memory" (per worker), "sqlite" (shared by all
+# workers on the box, stored in FEED_CACHE_PATH) or "none"
+app.config["FEED_CACHE_BACKEND"] = os.environ.get("FEED_CACHE_BACKEND", "memory")
+app.config["FEED_CACHE_PATH"] = os.environ.get("FEED_CACHE_PATH", os.path.join(BASE_DIR, "cache.db"))
+app.config["FEED_CACHE_SIZE"] = int(os.environ.get("FEED_CACHE_SIZE", 512))
+app.config["FEED_CACHE_TTL"] = float(os.environ.get("FEED_CACHE_TTL", 300))
+# Rendered portfolio cards, per worker; entries are keyed by item version so never go stale
+app.config["CARD_CACHE_SIZE"] = int(os.environ.get("CARD_CACHE_SIZE", 2048))
+# How long shared caches may reuse an anonymous feed/profile page before
+# revalidating it; 0 means every reuse is checked against its ETag
+app.config["PUBLIC_PAGE_MAX_AGE"] = int(os.environ.get("PUBLIC_PAGE_MAX_AGE", 0))
+# Thumbnails / WebP variants are made by generate_variants jobs (`flask jobs work`)
+app.config["IMAGE_PIPELINE"] = os.environ.get("IMAGE_PIPELINE", "1") != "0"
+# Upload names never change content, so browsers and proxies may keep them for a year
+app.config["UPLOADS_MAX_AGE"] = int(os.environ.get("UPLOADS_MAX_AGE", 365 * 24 * 3600))
+# Let the front web server send upload bytes: "x-accel" (nginx) or "x-sendfile"
+# (Apache / lighttpd). For nginx, UPLOADS_ACCEL_PREFIX must be an internal location
+# aliased to UPLOAD_FOLDER, e.g.  location /protected-uploads/ { internal; alias .../static/uploads/; }
+app.config["UPLOADS_OFFLOAD"] = os.environ.get("UPLOADS_OFFLOAD", "")
+app.config["UPLOADS_ACCEL_PREFIX"] = os.environ.get("UPLOADS_ACCEL_PREFIX", "/protected-uploads/")
+app.config["USE_X_SENDFILE"] = app.config["UPLOADS_OFFLOAD"] == "x-sendfile"
+# Background jobs ("flask jobs work"): a claimed job is hidden from other workers
+# for JOB_VISIBILITY_TIMEOUT seconds; failures retry after JOB_RETRY_DELAY * 2^n
+# seconds until JOB_MAX_ATTEMPTS, then the job is kept as "dead"
+app.config["JOB_VISIBILITY_TIMEOUT"] = int(os.environ.get("JOB_VISIBILITY_TIMEOUT", 300))
+app.config["JOB_RETRY_DELAY"] = float(os.environ.get("JOB_RETRY_DELAY", 10))
+app.config["JOB_MAX_ATTEMPTS"] = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+# Share of requests whose SQL and template time is measured and kept for
+# /_debug/requests; requests carrying OPS_TOKEN are always measured and are the
+# only ones that get it back as a Server-Timing header
+app.config["INSTRUMENT_SAMPLE_RATE"] = float(os.environ.get("INSTRUMENT_SAMPLE_RATE", 0))
+# Measured requests kept per worker for /_debug/requests
+app.config["INSTRUMENT_HISTORY"] = int(os.environ.get("INSTRUMENT_HISTORY", 50))
+# Secret for operational endpoints (X-Ops-Token or "Authorization: Bearer ...");
+# empty disables them
+app.config["OPS_TOKEN"] = os.environ.get("OPS_TOKEN", "")
+# cProfile single requests, either ones carrying a token from "flask profile token"
+# (X-Profile header or ?_profile=) or a random PROFILER_SAMPLE_RATE share; dumps
+# go to PROFILE_DIR, which keeps the newest PROFILE_KEEP of them
+app.config["PROFILER_ENABLED"] = os.environ.get("PROFILER_ENABLED", "0") != "0"
+app.config["PROFILER_SAMPLE_RATE"] = float(os.environ.get("PROFILER_SAMPLE_RATE", 0))
+app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", os.path.join(BASE_DIR, "profiles"))
+app.config["PROFILE_KEEP"] = int(os.environ.get("PROFILE_KEEP", 200))
+app.config["PROFILE_TOKEN_MAX_AGE"] = int(os.environ.get("PROFILE_TOKEN_MAX_AGE", 3600))
+# Opt-in: statements slower than SLOW_QUERY_MS (0, the default, turns it off)
+# are appended to SLOW_QUERY_LOG as JSON lines with their EXPLAIN QUERY PLAN,
+# run inside the request. Only SLOW_QUERY_SAMPLE_RATE of statements are timed,
+# and a per-worker cap per minute keeps a bad spell from flooding the file
+app.config["SLOW_QUERY_MS"] = float(os.environ.get("SLOW_QUERY_MS", 0))
+app.config["SLOW_QUERY_LOG"] = os.environ.get("SLOW_QUERY_LOG", os.path.join(BASE_DIR, "slow_queries.jsonl"))
+app.config["SLOW_QUERY_SAMPLE_RATE"] = float(os.environ.get("SLOW_QUERY_SAMPLE_RATE", 1))
+app.config["SLOW_QUERY_MAX_PER_MINUTE"] = int(os.environ.get("SLOW_QUERY_MAX_PER_MINUTE", 30))
+# Prometheus metrics: each worker writes its totals to METRICS_DIR at most every
+# METRICS_FLUSH_INTERVAL seconds; /metrics (needs OPS_TOKEN) adds them all up
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "1") != "0"
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR", os.path.join(BASE_DIR, "metrics"))
+app.config["METRICS_FLUSH_INTERVAL"] = float(os.environ.get("METRICS_FLUSH_INTERVAL", 2))
+app.permanent_session_lifetime = timedelta(days=30)
+
+os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+
+
+# --- DATABASE HELPERS ---
+
+def configure_connection(conn):
+    """Per-connection settings, applied once when the pool opens a connection."""
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers and the writer run concurrently instead of locking
+    # the whole file; it is persistent, so this is a no-op after the first time.
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{int(app.config['DB_CACHE_SIZE_KB'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['DB_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA busy_timeout = {int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def connect_db():
+    # Pooled connections move between request threads, one request at a time.
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=InstrumentedConnection)
+    return configure_connection(conn)
+
+
+def connect_read_db():
+    conn = sqlite3.connect(
+        f"file:{quote(DB_PATH)}?mode=ro",
+        uri=True,
+        check_same_thread=False,
+        factory=InstrumentedConnection,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA cache_size = -{int(app.config['DB_CACHE_SIZE_KB'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['DB_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA busy_timeout = {int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA query_only = 1")
+    return conn
+
+
+class ConnectionPool:
+    """Keeps up to `size` idle connections per worker process for reuse.
+
+    Bursts above `size` still get a connection; the extra ones are closed
+    when released instead of being kept.
+    """
+
+    def __init__(self, connect, size):
+        self._connect = connect
+        self.size = size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # LIFO hands out the most recently used (warmest) connection first.
+        self._idle = queue.LifoQueue()
+        self._stats = {"created": 0, "reused": 0, "closed": 0, "in_use": 0}
+
+    def _check_fork(self):
+        # Connections must not be shared across a fork (gunicorn --preload);
+        # a new worker simply starts with an empty pool.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def acquire(self):
+        self._check_fork()
+        try:
+            conn = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = self._connect()
+            reused = False
+        with self._lock:
+            self._stats["reused" if reused else "created"] += 1
+            self._stats["in_use"] += 1
+        return conn
+
+    def release(self, conn):
+        self._check_fork()
+        keep = True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            keep = False
+        with self._lock:
+            self._stats["in_use"] = max(0, self._stats["in_use"] - 1)
+            if keep and self._idle.qsize() < self.size:
+                self._idle.put(conn)
+                return
+            self._stats["closed"] += 1
+        conn.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(pid=self._pid, size=self.size, idle=self._idle.qsize())
+        return stats
+
+
+_pools = {}
+
+
+def get_pool(kind="write"):
+    pool = _pools.get(kind)
+    if pool is None:
+        if kind == "read":
+            pool = ConnectionPool(connect_read_db, app.config["DB_READ_POOL_SIZE"])
+        else:
+            pool = ConnectionPool(connect_db, app.config["DB_POOL_SIZE"])
+        pool = _pools.setdefault(kind, pool)
+    return pool
+
+
+def pool_stats():
+    return {kind: pool.stats() for kind, pool in _pools.items()}
+
+
+def get_db():
+    """Read-write connection. Writes should go through write_transaction()."""
+    if "db" not in g:
+        g.db = get_pool("write").acquire()
+    return g.db
+
+
+def get_read_db():
+    """Read-only connection for pages that never write (mode=ro, query_only)."""
+    if "read_db" not in g:
+        g.read_db = get_pool("read").acquire()
+    return g.read_db
+
+
+@app.teardown_appcontext
+def close_db(exc):
+    db = g.pop("db", None)
+    if db is not None:
+        get_pool("write").release(db)
+    read_db = g.pop("read_db", None)
+    if read_db is not None:
+        get_pool("read").release(read_db)
+
+
+class DatabaseBusy(Exception):
+    """The write lock could not be taken; reported to the client as 503."""
+
+
+def is_busy_error(exc) -> bool:
+    code = getattr(exc, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(exc).lower()
+    return "locked" in message or "busy" in message
+
+
+_write_lock = threading.Lock()
+
+
+@contextmanager
+def write_transaction():
+    """Run all of a request's writes as one serialized transaction.
+
+    Threads in this worker queue on a lock, other workers on SQLite's write
+    lock via BEGIN IMMEDIATE; SQLITE_BUSY is retried here with backoff and
+    becomes DatabaseBusy if the lock never frees up. Reads outside it belong
+    on get_read_db(): a transaction already open on the write connection is
+    a bug and raises rather than being committed along with this one.
+    """
+    db = get_db()
+    if db.in_transaction:
+        raise RuntimeError("write_transaction() entered with a transaction already open")
+    with _write_lock:
+        retries = app.config["DB_WRITE_RETRIES"]
+        for attempt in range(retries + 1):
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as exc:
+                if not is_busy_error(exc):
+                    raise
+                if attempt == retries:
+                    raise DatabaseBusy(str(exc)) from exc
+                time.sleep(0.05 * 2 ** attempt)
+        try:
+            yield db
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+
+
+# --- REQUEST INSTRUMENTATION ---
+
+# Profile of the request being handled, or None when it is not sampled.
+_request_profile = ContextVar("request_profile", default=None)
+_recent_profiles = deque()
+_recent_profiles_lock = threading.Lock()
+
+
+class QueryRecord:
+    """One executed statement; fetches keep adding to its time and row count."""
+
+    __slots__ = ("sql", "parameters", "seconds", "rows", "reported")
+
+    def __init__(self, sql, parameters):
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = 0.0
+        self.rows = 0
+        self.reported = False
+
+
+class RequestProfile:
+    """Where one request spent its time.
+
+    Only sampled requests are `detailed` and keep every statement; the others
+    just count queries for the metrics. Timings are internals: only `exposed`
+    (OPS_TOKEN) requests send them back in a Server-Timing header.
+    """
+
+    __slots__ = ("started", "queries", "query_count", "render_time", "_render_started", "exposed")
+
+    def __init__(self, detailed=True, exposed=False):
+        self.started = time.perf_counter()
+        self.exposed = exposed
+        self.queries = [] if detailed else None
+        self.query_count = 0
+        self.render_time = 0.0
+        self._render_started = None
+
+    @property
+    def detailed(self):
+        return self.queries is not None
+
+    @property
+    def db_time(self):
+        return sum(q.seconds for q in self.queries)
+
+    @property
+    def rows(self):
+        return sum(q.rows for q in self.queries)
+
+    def server_timing(self, total):
+        return (
+            f'db;dur={self.db_time * 1000:.2f};desc="{len(self.queries)} queries, {self.rows} rows", '
+            f"tpl;dur={self.render_time * 1000:.2f}, "
+            f"total;dur={total * 1000:.2f}"
+        )
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Times statements for the sampled request's profile and the slow-query log.
+
+    Outside sampled requests a statement runs untimed and is only counted,
+    unless the slow-query log is on and picks it by SLOW_QUERY_SAMPLE_RATE.
+    """
+
+    _query = None
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        # The parameters of a batch may be a one-shot iterator: not kept for EXPLAIN.
+        return self._run(super().executemany, sql, seq_of_parameters, None)
+
+    def _run(self, method, sql, parameters, recorded_parameters):
+        profile = _request_profile.get()
+        if profile is not None:
+            profile.query_count += 1
+        detailed = profile is not None and profile.queries is not None
+        watched = bool(app.config["SLOW_QUERY_MS"]) and random.random() < app.config["SLOW_QUERY_SAMPLE_RATE"]
+        if not detailed and not watched:
+            self._query = None
+            return method(sql, parameters)
+        self._query = QueryRecord(sql, recorded_parameters)
+        # Statements the slow-query log did not pick are never reported.
+        self._query.reported = not watched
+        if detailed:
+            profile.queries.append(self._query)
+        start = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        finally:
+            self._timed(start, 0)
+
+    def _timed(self, start, rows):
+        query = self._query
+        query.seconds += time.perf_counter() - start
+        query.rows += rows
+        threshold = app.config["SLOW_QUERY_MS"]
+        if threshold and not query.reported and query.seconds * 1000 >= threshold:
+            query.reported = True
+            log_slow_query(self.connection, query)
+
+    def fetchone(self):
+        if self._query is None:
+            return super().fetchone()
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._timed(start, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        if self._query is None:
+            return super().fetchmany(size or self.arraysize)
+        start = time.perf_counter()
+        rows = super().fetchmany(size or self.arraysize)
+        self._timed(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        if self._query is None:
+            return super().fetchall()
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._timed(start, len(rows))
+        return rows
+
+    def __next__(self):
+        if self._query is None:
+            return super().__next__()
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._timed(start, 0)
+            raise
+        self._timed(start, 1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+_slow_query_window = [0.0, 0]  # [minute started (monotonic), entries written in it]
+_slow_query_lock = threading.Lock()
+
+
+def parameter_shape(parameters):
+    """Types of the bound values; the values themselves are never logged."""
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    return [type(value).__name__ for value in parameters]
+
+
+def explain_query_plan(conn, sql, parameters):
+    try:
+        # A plain cursor, so the EXPLAIN itself is not timed or logged.
+        rows = conn.cursor(sqlite3.Cursor).execute(f"EXPLAIN QUERY PLAN {sql}", parameters or ()).fetchall()
+    except sqlite3.Error:
+        return None
+    depth = {0: -1}
+    plan = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        plan.append("  " * depth[node_id] + detail)
+    return plan
+
+
+def normalize_sql(sql):
+    """The statement with literals as ? and IN lists collapsed, for grouping."""
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(...)", sql)
+    return " ".join(sql.split())
+
+
+def log_slow_query(conn, query):
+    """Append a statement that just crossed SLOW_QUERY_MS to the slow-query log.
+
+    `ms` and `rows` are as of that moment: a lazily fetched SELECT is logged
+    from the fetch that took it over the threshold.
+    """
+    now = time.monotonic()
+    with _slow_query_lock:
+        if now - _slow_query_window[0] >= 60:
+            _slow_query_window[:] = [now, 0]
+        if _slow_query_window[1] >= app.config["SLOW_QUERY_MAX_PER_MINUTE"]:
+            return
+        _slow_query_window[1] += 1
+    entry = {
+        "at": datetime.utcnow().isoformat(),
+        "pid": os.getpid(),
+        "endpoint": request.endpoint if has_request_context() else None,
+        "ms": round(query.seconds * 1000, 3),
+        "rows": query.rows,
+        "sql": " ".join(query.sql.split()),
+        "params": parameter_shape(query.parameters),
+        "plan": explain_query_plan(conn, query.sql, query.parameters),
+    }
+    try:
+        with open(app.config["SLOW_QUERY_LOG"], "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError:
+        app.logger.exception("Could not write to the slow-query log")
+
+
+def summarize_slow_queries(path, since=None):
+    """Slow-query log entries grouped by normalized statement, worst total time first."""
+    groups = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if since is not None and entry["at"] < since:
+                continue
+            key = normalize_sql(entry["sql"])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {
+                    "sql": key, "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                    "endpoints": set(), "params": None, "plan": None,
+                }
+            group["count"] += 1
+            group["total_ms"] += entry["ms"]
+            if entry["endpoint"]:
+                group["endpoints"].add(entry["endpoint"])
+            if entry["ms"] >= group["max_ms"]:
+                # Keep the plan and parameter shape of the slowest run.
+                group["max_ms"] = entry["ms"]
+                group["params"] = entry["params"]
+                group["plan"] = entry["plan"]
+    return sorted(groups.values(), key=lambda group: group["total_ms"], reverse=True)
+
+
+def has_ops_token() -> bool:
+    token = app.config["OPS_TOKEN"]
+    if not token:
+        return False
+    supplied = request.headers.get("X-Ops-Token")
+    if supplied is None:
+        auth = request.headers.get("Authorization", "")
+        supplied = auth[len("Bearer "):] if auth.startswith("Bearer ") else ""
+    return hmac.compare_digest(supplied.encode(), token.encode())
+
+
+@app.before_request
+def start_request_profile():
+    if request.endpoint in ("debug_requests", "metrics"):
+        return
+    rate = app.config["INSTRUMENT_SAMPLE_RATE"]
+    exposed = has_ops_token()
+    detailed = exposed or (rate > 0 and random.random() < rate)
+    if detailed or app.config["METRICS_ENABLED"]:
+        g.profile = RequestProfile(detailed, exposed)
+        _request_profile.set(g.profile)
+
+
+@before_render_template.connect_via(app)
+def _template_render_started(sender, template, context, **extra):
+    profile = _request_profile.get()
+    if profile is not None:
+        profile._render_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def _template_render_finished(sender, template, context, **extra):
+    profile = _request_profile.get()
+    if profile is not None and profile._render_started is not None:
+        profile.render_time += time.perf_counter() - profile._render_started
+        profile._render_started = None
+
+
+@app.after_request
+def finish_request_profile(response):
+    profile = g.get("profile")
+    if profile is None or not profile.detailed:
+        return response
+    total = time.perf_counter() - profile.started
+    if profile.exposed:
+        response.headers["Server-Timing"] = profile.server_timing(total)
+    entry = {
+        "at": datetime.utcnow().isoformat(),
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "total_ms": round(total * 1000, 3),
+        "db_ms": round(profile.db_time * 1000, 3),
+        "render_ms": round(profile.render_time * 1000, 3),
+        "query_count": len(profile.queries),
+        "rows": profile.rows,
+        "queries": [
+            {"sql": " ".join(q.sql.split()), "ms": round(q.seconds * 1000, 3), "rows": q.rows}
+            for q in profile.queries
+        ],
+    }
+    with _recent_profiles_lock:
+        _recent_profiles.appendleft(entry)
+        while len(_recent_profiles) > app.config["INSTRUMENT_HISTORY"]:
+            _recent_profiles.pop()
+    return response
+
+
+METRIC_TYPES = {
+    "portfohub_http_requests_total": ("counter", "Requests handled, by endpoint, method and status."),
+    "portfohub_http_request_duration_seconds": ("histogram", "Request latency by endpoint."),
+    "portfohub_db_queries_total": ("counter", "SQL statements executed while handling requests."),
+    "portfohub_upload_bytes_total": ("counter", "Bytes of uploaded images stored or deduplicated."),
+    "portfohub_uploads_total": ("counter", "Uploaded images accepted."),
+    "portfohub_cache_hits_total": ("counter", "Cache lookups that found an entry."),
+    "portfohub_cache_misses_total": ("counter", "Cache lookups that found nothing."),
+    "portfohub_db_pool_connections": ("gauge", "Pooled SQLite connections by pool and state (in_use, idle)."),
+    "portfohub_db_pool_acquires_total": ("counter", "Pool checkouts, by whether a new connection was opened."),
+}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# This worker's totals since it started: {name: {labels_json: value}}; histogram
+# values are [count per bucket..., count above the last bucket, sum].
+_metrics = {}
+_metrics_lock = threading.Lock()
+_metrics_pid = None
+# Names this process's file in METRICS_DIR as <pid>-<token>.json: pids get
+# reused, and a new worker must not overwrite an exited one's totals.
+_metrics_token = None
+_metrics_flushed = 0.0
+_metrics_flushed_pid = None
+
+
+def _worker_metrics():
+    global _metrics, _metrics_pid, _metrics_token
+    if _metrics_pid != os.getpid():
+        # Forked worker: totals of the parent are not ours.
+        _metrics = {}
+        _metrics_pid = os.getpid()
+        _metrics_token = uuid4().hex
+    return _metrics
+
+
+def inc_metric(name, labels, value=1):
+    key = json.dumps(labels, sort_keys=True)
+    with _metrics_lock:
+        series = _worker_metrics().setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def observe_metric(name, labels, value):
+    key = json.dumps(labels, sort_keys=True)
+    with _metrics_lock:
+        series = _worker_metrics().setdefault(name, {})
+        buckets = series.get(key)
+        if buckets is None:
+            buckets = series[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                buckets[i] += 1
+                break
+        else:
+            buckets[len(LATENCY_BUCKETS)] += 1
+        buckets[-1] += value
+
+
+def metrics_snapshot():
+    """This worker's totals, including cache counters, as written to METRICS_DIR."""
+    with _metrics_lock:
+        snapshot = {
+            name: {key: list(value) if isinstance(value, list) else value for key, value in series.items()}
+            for name, series in _worker_metrics().items()
+        }
+    for name, stats in cache_stats().items():
+        key = json.dumps({"cache": name})
+        snapshot.setdefault("portfohub_cache_hits_total", {})[key] = stats.get("hits", 0)
+        snapshot.setdefault("portfohub_cache_misses_total", {})[key] = stats.get("misses", 0)
+    for kind, stats in pool_stats().items():
+        connections = snapshot.setdefault("portfohub_db_pool_connections", {})
+        acquires = snapshot.setdefault("portfohub_db_pool_acquires_total", {})
+        for state in ("in_use", "idle"):
+            connections[json.dumps({"pool": kind, "state": state}, sort_keys=True)] = stats[state]
+        for result in ("created", "reused"):
+            acquires[json.dumps({"pool": kind, "result": result}, sort_keys=True)] = stats[result]
+    return snapshot
+
+
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def flush_metrics():
+    global _metrics_flushed, _metrics_flushed_pid
+    snapshot = metrics_snapshot()
+    folder = app.config["METRICS_DIR"]
+    os.makedirs(folder, exist_ok=True)
+    if _metrics_flushed_pid != os.getpid():
+        # First write of this process: files an earlier process with the same
+        # pid left behind go to the archive before ours appears next to them.
+        with metrics_dir_lock(folder):
+            archive_exited_workers(folder)
+        _metrics_flushed_pid = os.getpid()
+    _metrics_flushed = time.monotonic()
+    write_json_atomic(os.path.join(folder, f"{_metrics_pid}-{_metrics_token}.json"), snapshot)
+
+
+def merge_metrics(total, part):
+    for name, series in part.items():
+        merged = total.setdefault(name, {})
+        for key, value in series.items():
+            if isinstance(value, list):
+                current = merged.get(key)
+                merged[key] = value if current is None else [a + b for a, b in zip(current, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return total
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+WORKER_METRICS_FILE = re.compile(r"^(\d+)(?:-([0-9a-f]+))?\.json$")
+
+
+@contextmanager
+def metrics_dir_lock(folder):
+    with open(os.path.join(folder, ".lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def worker_metrics_files(folder):
+    """(path, exited) of every per-worker file; call with metrics_dir_lock held.
+
+    A file is from an exited worker when its pid is gone, or when the pid is
+    ours but the token is not: an earlier process had the same pid.
+    """
+    for entry in os.scandir(folder):
+        match = WORKER_METRICS_FILE.match(entry.name)
+        if match is None:
+            continue
+        pid, token = int(match.group(1)), match.group(2)
+        if pid == os.getpid():
+            exited = token != _metrics_token
+        else:
+            exited = not pid_alive(pid)
+        yield entry.path, exited
+
+
+def read_metrics_file(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def archive_exited_workers(folder):
+    """Fold the files of exited workers into archived.json and return its totals.
+
+    Only counters and histograms are kept: gauges of a gone worker mean nothing.
+    """
+    archive_path = os.path.join(folder, "archived.json")
+    archived = read_metrics_file(archive_path) or {}
+    changed = False
+    for path, exited in worker_metrics_files(folder):
+        if not exited:
+            continue
+        part = read_metrics_file(path)
+        if part is not None:
+            part = {name: series for name, series in part.items() if METRIC_TYPES.get(name, ("",))[0] != "gauge"}
+            merge_metrics(archived, part)
+            changed = True
+        os.unlink(path)
+    if changed:
+        write_json_atomic(archive_path, archived)
+    return archived
+
+
+def collect_metrics():
+    """Totals of every worker: live ones from their files, exited ones from archived.json.
+
+    Files of exited workers are folded into archived.json so counters never go
+    backwards when gunicorn recycles a worker.
+    """
+    folder = app.config["METRICS_DIR"]
+    flush_metrics()
+    with metrics_dir_lock(folder):
+        total = merge_metrics({}, archive_exited_workers(folder))
+        for path, _ in worker_metrics_files(folder):
+            part = read_metrics_file(path)
+            if part is not None:
+                merge_metrics(total, part)
+    return total
+
+
+def format_labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def render_metrics(total):
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for name, (kind, help_text) in METRIC_TYPES.items():
+        series = total.get(name)
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key in sorted(series):
+            labels = json.loads(key)
+            value = series[key]
+            if kind != "histogram":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels({**labels, 'le': str(bound)})} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def record_upload_metrics(size):
+    if app.config["METRICS_ENABLED"]:
+        inc_metric("portfohub_uploads_total", {})
+        inc_metric("portfohub_upload_bytes_total", {}, size)
+
+
+@app.after_request
+def record_request_metrics(response):
+    profile = g.get("profile")
+    if profile is None or not app.config["METRICS_ENABLED"]:
+        return response
+    endpoint = request.endpoint or "unmatched"
+    inc_metric(
+        "portfohub_http_requests_total",
+        {"endpoint": endpoint, "method": request.method, "status": str(response.status_code)},
+    )
+    observe_metric(
+        "portfohub_http_request_duration_seconds",
+        {"endpoint": endpoint},
+        time.perf_counter() - profile.started,
+    )
+    if profile.query_count:
+        inc_metric("portfohub_db_queries_total", {"endpoint": endpoint}, profile.query_count)
+    if time.monotonic() - _metrics_flushed >= app.config["METRICS_FLUSH_INTERVAL"]:
+        try:
+            flush_metrics()
+        except OSError:
+            app.logger.exception("Could not write metrics to %s", app.config["METRICS_DIR"])
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    if not app.config["METRICS_ENABLED"] or not has_ops_token():
+        abort(404)
+    return Response(render_metrics(collect_metrics()), mimetype="text/plain; version=0.0.4")
+
+
+@app.teardown_request
+def clear_request_profile(exc):
+    _request_profile.set(None)
+
+
+@app.route("/_debug/requests")
+def debug_requests():
+    """Recently measured requests in this worker, newest first (needs OPS_TOKEN)."""
+    if not has_ops_token():
+        abort(404)
+    with _recent_profiles_lock:
+        profiles = list(_recent_profiles)
+    return jsonify(pid=os.getpid(), sample_rate=app.config["INSTRUMENT_SAMPLE_RATE"], requests=profiles)
+
+
+# --- SEARCH INDEX ---
+
+def sqlite_has_fts5() -> bool:
+    try:
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE VIRTUAL TABLE fts5_probe USING fts5(body)")
+        conn.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+# SQLite build without FTS5 -> index() falls back to LIKE substring search.
+HAS_FTS5 = sqlite_has_fts5()
+
+# bm25 column weights: title, tags, description, owner
+SEARCH_WEIGHTS = (10.0, 5.0, 1.0, 3.0)
+
+SEARCH_INDEX_SQL = """
+    INSERT INTO portfolio_search (rowid, title, tags, description, owner)
+    SELECT p.id, p.title, COALESCE(p.tags, ''), COALESCE(p.description, ''),
+           u.username || ' ' || u.full_name
+    FROM portfolio_items p
+    JOIN users u ON p.user_id = u.id
+"""
+
+
+def create_search_index(db):
+    """Create the FTS5 table; fill it the first time it appears."""
+    if not HAS_FTS5:
+        return
+    exists = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'portfolio_search'"
+    ).fetchone()
+    if exists:
+        return
+    db.execute(
+        """
+        CREATE VIRTUAL TABLE portfolio_search USING fts5(
+            title, tags, description, owner,
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+        """
+    )
+    db.execute(SEARCH_INDEX_SQL)
+
+
+def rebuild_search_index(db):
+    if not HAS_FTS5:
+        return 0
+    db.execute("DELETE FROM portfolio_search")
+    db.execute(SEARCH_INDEX_SQL)
+    return db.execute("SELECT COUNT(*) FROM portfolio_search").fetchone()[0]
+
+
+def index_portfolio_item(db, item_id):
+    if not HAS_FTS5:
+        return
+    db.execute("DELETE FROM portfolio_search WHERE rowid = ?", (item_id,))
+    db.execute(SEARCH_INDEX_SQL + " WHERE p.id = ?", (item_id,))
+
+
+def unindex_portfolio_item(db, item_id):
+    if not HAS_FTS5:
+        return
+    db.execute("DELETE FROM portfolio_search WHERE rowid = ?", (item_id,))
+
+
+def reindex_user_items(db, user_id):
+    """Owner name is part of every item's document, so refresh them all."""
+    if not HAS_FTS5:
+        return
+    db.execute(
+        "DELETE FROM portfolio_search WHERE rowid IN (SELECT id FROM portfolio_items WHERE user_id = ?)",
+        (user_id,),
+    )
+    db.execute(SEARCH_INDEX_SQL + " WHERE p.user_id = ?", (user_id,))
+
+
+def build_match_query(q: str):
+    """Turn free text into an FTS5 prefix query, e.g. 'web design' -> '"web"* "design"*'."""
+    terms = re.findall(r"\w+", q.lower())
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+search_cli = AppGroup("search", help="Full-text search index commands.")
+
+
+@search_cli.command("rebuild")
+def rebuild_search_command():
+    """Rebuild the full-text search index from portfolio_items."""
+    if not HAS_FTS5:
+        click.echo("This SQLite build has no FTS5; search uses LIKE fallback.")
+        return
+    with write_transaction() as db:
+        create_search_index(db)
+        count = rebuild_search_index(db)
+    click.echo(f"Indexed {count} portfolio items.")
+
+
+app.cli.add_command(search_cli)
+
+
+# --- SCHEMA MIGRATIONS ---
+
+# (version, description, function); applied in version order, each in its
+# own transaction, and recorded in the schema_version table.
+MIGRATIONS = []
+
+
+def migration(version: int, description: str):
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+
+    return decorator
+
+
+@migration(1, "Composite indexes for feed, profile and category queries")
+def add_listing_indexes(db):
+    # Public feed: WHERE visibility = 'public' ORDER BY created_at, id
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_items_visibility_created "
+        "ON portfolio_items (visibility, created_at, id)"
+    )
+    # Category filter, and a covering index for SELECT DISTINCT category
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_items_visibility_category_created "
+        "ON portfolio_items (visibility, category, created_at, id)"
+    )
+    # /profile: WHERE user_id = ? ORDER BY created_at, id
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_items_user_created "
+        "ON portfolio_items (user_id, created_at, id)"
+    )
+    # /u/<username>: WHERE user_id = ? AND visibility = 'public' ORDER BY created_at, id
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_items_user_visibility_created "
+        "ON portfolio_items (user_id, visibility, created_at, id)"
+    )
+
+
+@migration(2, "Collect planner statistics")
+def analyze_tables(db):
+    db.execute("ANALYZE")
+
+
+@migration(3, "Data generation counter for cache invalidation")
+def add_app_state(db):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        """
+    )
+    db.execute("INSERT OR IGNORE INTO app_state (key, value) VALUES ('data_generation', 0)")
+
+
+@migration(4, "Category and tag facet counts for the public feed")
+def add_facet_tables(db):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS category_facets (
+            category TEXT PRIMARY KEY,
+            item_count INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tag_facets (
+            tag TEXT PRIMARY KEY,
+            item_count INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        """
+    )
+    rebuild_facets(db)
+
+
+@migration(5, "Normalized tags with an item_tags inverted index")
+def add_tag_tables(db):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tags (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS item_tags (
+            tag_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            PRIMARY KEY (tag_id, item_id)
+        ) WITHOUT ROWID;
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_item_tags_item ON item_tags (item_id, tag_id)")
+    rows = db.execute("SELECT id, tags FROM portfolio_items WHERE tags IS NOT NULL AND tags != ''").fetchall()
+    for row in rows:
+        # Inlined rather than set_item_tags(), whose columns only exist from migration 13.
+        for tag in parse_tags(row["tags"]):
+            db.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
+            db.execute(
+                "INSERT OR IGNORE INTO item_tags (tag_id, item_id) SELECT id, ? FROM tags WHERE name = ?",
+                (row["id"], tag),
+            )
+
+
+@migration(6, "Image variant columns for portfolio images and avatars")
+def add_image_variant_columns(db):
+    db.execute("ALTER TABLE portfolio_items ADD COLUMN image_variants TEXT")
+    db.execute("ALTER TABLE users ADD COLUMN avatar_variants TEXT")
+
+
+@migration(7, "Reference-counted upload blobs")
+def add_upload_blobs(db):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS upload_blobs (
+            filename TEXT PRIMARY KEY,
+            sha256 TEXT,
+            size INTEGER,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        ) WITHOUT ROWID;
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_items_image_filename ON portfolio_items (image_filename)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_users_avatar_filename ON users (avatar_filename)")
+    # Existing uploads: count references; their hash is unknown until re-stored.
+    db.execute(
+        """
+        INSERT OR IGNORE INTO upload_blobs (filename, refcount, created_at)
+        SELECT filename, COUNT(*), ? FROM (
+            SELECT avatar_filename AS filename FROM users
+            WHERE avatar_filename IS NOT NULL AND avatar_filename != ''
+            UNION ALL
+            SELECT image_filename FROM portfolio_items
+            WHERE image_filename IS NOT NULL AND image_filename != ''
+        )
+        GROUP BY filename
+        """,
+        (datetime.utcnow().isoformat(),),
+    )
+
+
+@migration(8, "Progress table for resumable maintenance commands")
+def add_task_progress(db):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS task_progress (
+            task TEXT PRIMARY KEY,
+            position TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        ) WITHOUT ROWID;
+        """
+    )
+
+
+@migration(9, "Background job queue")
+def add_jobs(db):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            run_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TEXT NOT NULL
+        );
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_pending_run_at ON jobs (run_at) WHERE state = 'pending'")
+
+
+@migration(10, "Last-modified time for user profiles")
+def add_user_updated_at(db):
+    db.execute("ALTER TABLE users ADD COLUMN updated_at TEXT")
+    db.execute("UPDATE users SET updated_at = created_at")
+
+
+@migration(11, "Time of the last data generation bump")
+def add_data_changed_at(db):
+    db.execute(
+        "INSERT OR IGNORE INTO app_state (key, value) VALUES ('data_changed_at', CAST(strftime('%s', 'now') AS INTEGER))"
+    )
+
+
+@migration(12, "Stored description excerpts for listing pages")
+def add_description_excerpt(db):
+    db.execute("ALTER TABLE portfolio_items ADD COLUMN description_excerpt TEXT")
+    # Same rule as description_excerpt(); length() and substr() count characters.
+    db.execute(
+        """
+        UPDATE portfolio_items SET description_excerpt =
+            CASE WHEN length(description) > ?1 THEN substr(description, 1, ?1) || '...'
+                 ELSE description END
+        """,
+        (EXCERPT_LENGTH,),
+    )
+
+
+@migration(13, "Feed sort key in item_tags for in-order tag pages")
+def add_item_tags_sort_key(db):
+    db.execute("ALTER TABLE item_tags ADD COLUMN visibility TEXT")
+    db.execute("ALTER TABLE item_tags ADD COLUMN created_at TEXT")
+    db.execute(
+        """
+        UPDATE item_tags SET (visibility, created_at) = (
+            SELECT visibility, created_at FROM portfolio_items WHERE id = item_tags.item_id
+        )
+        """
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_item_tags_feed "
+        "ON item_tags (tag_id, visibility, created_at, item_id)"
+    )
+
+
+def ensure_schema_version_table(db):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        );
+        """
+    )
+
+
+def current_schema_version(db) -> int:
+    ensure_schema_version_table(db)
+    return db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def upgrade_db(db, target=None):
+    """Apply pending migrations up to `target` (default: latest). Returns applied versions."""
+    ensure_schema_version_table(db)
+    db.commit()
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        # BEGIN IMMEDIATE takes the write lock, so several gunicorn workers
+        # starting at once apply each step exactly once.
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= current_schema_version(db):
+                db.rollback()
+                continue
+            fn(db)
+            db.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.utcnow().isoformat()),
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+db_cli = AppGroup("db", help="Database schema commands.")
+
+
+@db_cli.command("rebuild-facets")
+def rebuild_facets_command():
+    """Recount category and tag facets from portfolio_items."""
+    with write_transaction() as db:
+        rebuild_facets(db)
+        bump_data_generation(db)
+    click.echo("Facet counts rebuilt.")
+
+
+@db_cli.command("upgrade")
+@click.option("--target", type=int, default=None, help="Stop after this schema version.")
+def db_upgrade_command(target):
+    """Apply pending schema migrations."""
+    db = get_db()
+    before = current_schema_version(db)
+    applied = upgrade_db(db, target=target)
+    if not applied:
+        click.echo(f"Database is up to date (version {before}).")
+        return
+    for version in applied:
+        click.echo(f"Applied migration {version}.")
+    click.echo(f"Database upgraded from version {before} to {current_schema_version(db)}.")
+
+
+@db_cli.command("status")
+def db_status_command():
+    """Show applied and pending schema migrations."""
+    db = get_db()
+    current = current_schema_version(db)
+    for version, description, _ in MIGRATIONS:
+        state = "applied" if version <= current else "pending"
+        click.echo(f"{version:>4}  {state:<8} {description}")
+
+
+@db_cli.command("slow-queries")
+@click.option("--top", default=10, show_default=True, help="Number of statements to show.")
+@click.option("--hours", type=float, default=None, help="Only look at the last N hours.")
+def slow_queries_command(top, hours):
+    """Summarize the slow-query log by normalized statement."""
+    path = app.config["SLOW_QUERY_LOG"]
+    if not os.path.exists(path):
+        click.echo("No slow queries logged.")
+        return
+    since = (datetime.utcnow() - timedelta(hours=hours)).isoformat() if hours else None
+    groups = summarize_slow_queries(path, since)
+    if not groups:
+        click.echo("No slow queries logged in that period.")
+    for group in groups[:top]:
+        endpoints = ", ".join(sorted(group["endpoints"])) or "-"
+        click.echo(
+            f"{group['total_ms']:10.1f} ms total  {group['count']:5d}x  "
+            f"avg {group['total_ms'] / group['count']:.1f} ms  max {group['max_ms']:.1f} ms  [{endpoints}]"
+        )
+        click.echo(f"    {group['sql']}")
+        click.echo(f"    params: {json.dumps(group['params'])}")
+        for line in group["plan"] or []:
+            click.echo(f"      {line}")
+        click.echo("")
+
+
+app.cli.add_command(db_cli)
+
+
+def init_db():
+    db = get_db()
+    # Users table
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            full_name TEXT NOT NULL,
+            username TEXT NOT NULL UNIQUE,
+            email TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            bio TEXT,
+            location TEXT,
+            website TEXT,
+            linkedin TEXT,
+            github TEXT,
+            profession TEXT,
+            avatar_filename TEXT,
+            created_at TEXT NOT NULL
+        );
+        """
+    )
+
+    # Portfolio items table
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS portfolio_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT,
+            category TEXT,
+            tags TEXT,
+            external_link TEXT,
+            image_filename TEXT,
+            visibility TEXT NOT NULL DEFAULT 'public',
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+        """
+    )
+
+    create_search_index(db)
+
+    db.commit()
+
+    if app.config["AUTO_MIGRATE"]:
+        upgrade_db(db)
+
+
+# --- UPLOAD INGESTION ---
+
+# Leading bytes of each allowed image type -> stored extension
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+SNIFF_BYTES = 16
+
+# Views that accept file uploads; all of them require a logged-in user.
+UPLOAD_ENDPOINTS = {"settings", "create_portfolio", "edit_portfolio"}
+
+
+def sniff_image_type(head: bytes):
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+class IncomingUpload:
+    """Destination for one multipart file part.
+
+    Werkzeug writes the part here chunk by chunk while it parses the body;
+    the bytes go straight to a temp file next to UPLOAD_FOLDER (so the final
+    rename is atomic) and are hashed and sniffed on the way. Nothing larger
+    than a chunk is ever held in memory.
+    """
+
+    def __init__(self, folder):
+        incoming = os.path.join(folder, ".incoming")
+        os.makedirs(incoming, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=incoming, suffix=".part")
+        self._file = os.fdopen(fd, "w+b")
+        self._digest = hashlib.sha256()
+        self.head = b""
+        self.size = 0
+
+    def write(self, data):
+        if len(self.head) < SNIFF_BYTES:
+            self.head += bytes(data[: SNIFF_BYTES - len(self.head)])
+        self._digest.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        # read / seek / tell / flush ... go to the temp file
+        return getattr(self._file, name)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def commit(self, target):
+        """Move the temp file to `target`, or drop it if `target` already exists."""
+        self._file.close()
+        try:
+            # A fresh mtime keeps the orphan GC off a file that is being re-used.
+            os.utime(target)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(self.path, target)
+        else:
+            os.unlink(self.path)
+        self.path = None
+
+    def close(self):
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+class DiscardedUpload:
+    """Sink for file parts that were rejected on their declared name or type."""
+
+    size = 0
+    head = b""
+
+    def write(self, data):
+        return len(data)
+
+    def read(self, size=-1):
+        return b""
+
+    def seek(self, offset, whence=0):
+        return 0
+
+    def tell(self):
+        return 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if not filename or not allowed_file(filename):
+            return DiscardedUpload()
+        if content_type and not content_type.startswith("image/") and content_type != "application/octet-stream":
+            return DiscardedUpload()
+        return IncomingUpload(app.config["UPLOAD_FOLDER"])
+
+
+app.request_class = UploadRequest
+
+
+@app.before_request
+def screen_uploads():
+    """Turn away upload POSTs on their headers, before the body is parsed."""
+    if request.method != "POST" or request.mimetype != "multipart/form-data":
+        return None
+    if request.content_length is None:
+        abort(411)
+    max_length = app.config["MAX_CONTENT_LENGTH"]
+    if max_length is not None and request.content_length > max_length:
+        abort(413)
+    if request.endpoint in UPLOAD_ENDPOINTS and "user_id" not in session:
+        flash("Please log in to access this page.", "warning")
+        return redirect(url_for("login", next=request.path))
+    header_token = request.headers.get("X-CSRFToken")
+    if header_token is not None and header_token != session.get("csrf_token"):
+        abort(400, description="Invalid CSRF token")
+    return None
+
+
+# --- CSRF PROTECTION ---
+
+def generate_csrf_token():
+    token = session.get("csrf_token")
+    if not token:
+        token = uuid4().hex
+        session["csrf_token"] = token
+    return token
+
+
+@app.before_request
+def csrf_protect():
+    # Only check for POST
+    if request.method == "POST":
+        token = session.get("csrf_token", None)
+        # Header first: reading request.form parses the whole body.
+        form_token = request.headers.get("X-CSRFToken") or request.form.get("csrf_token")
+        if not token or not form_token or token != form_token:
+            abort(400, description="Invalid CSRF token")
+
+
+@app.route("/set-lang/<lang_code>")
+def set_language(lang_code):
+    if lang_code not in LANGUAGES:
+        lang_code = "en"
+    session["lang"] = lang_code
+    next_url = request.referrer or url_for("index")
+    return redirect(next_url)
+
+
+@app.context_processor
+def inject_globals():
+    return {
+        "current_user": get_current_user(),
+        "csrf_token": generate_csrf_token,
+        "t": translator(get_locale()),
+        "current_lang": get_locale(),
+        "languages": LANGUAGES,
+    }
+
+
+# --- REQUEST PROFILER ---
+
+# One profiled request per worker at a time: on newer Pythons cProfile hooks
+# every thread, so overlapping profiles would also mix up their stacks.
+_profiler_lock = threading.Lock()
+
+
+def profiler_serializer():
+    return URLSafeTimedSerializer(app.config["SECRET_KEY"], salt="request-profiler")
+
+
+def has_profile_token() -> bool:
+    token = request.headers.get("X-Profile") or request.args.get("_profile")
+    if not token:
+        return False
+    try:
+        profiler_serializer().loads(token, max_age=app.config["PROFILE_TOKEN_MAX_AGE"])
+    except BadSignature:
+        return False
+    return True
+
+
+@app.before_request
+def start_profiler():
+    if not app.config["PROFILER_ENABLED"]:
+        return
+    requested = has_profile_token()
+    rate = app.config["PROFILER_SAMPLE_RATE"]
+    if not requested and not (rate > 0 and random.random() < rate):
+        return
+    if not _profiler_lock.acquire(blocking=False):
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler (a debugger, say) is already active
+        _profiler_lock.release()
+        return
+    g.profiler = profiler
+    g.profiler_requested = requested
+    g.profiler_started = time.perf_counter()
+
+
+def stop_profiler():
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return None
+    profiler.disable()
+    _profiler_lock.release()
+    return profiler
+
+
+def prune_profiles(folder):
+    dumps = sorted(
+        (entry for entry in os.scandir(folder) if entry.name.endswith(".prof")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in dumps[: max(0, len(dumps) - app.config["PROFILE_KEEP"])]:
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+@app.after_request
+def save_profile(response):
+    profiler = stop_profiler()
+    if profiler is None:
+        return response
+    elapsed_ms = (time.perf_counter() - g.profiler_started) * 1000
+    folder = app.config["PROFILE_DIR"]
+    name = (
+        f"{datetime.utcnow():%Y%m%dT%H%M%S}-{request.endpoint or 'unmatched'}"
+        f"-{elapsed_ms:.0f}ms-{os.getpid()}-{uuid4().hex[:6]}.prof"
+    )
+    try:
+        os.makedirs(folder, exist_ok=True)
+        profiler.dump_stats(os.path.join(folder, name))
+        prune_profiles(folder)
+    except OSError:
+        app.logger.exception("Could not write profile %s", name)
+        return response
+    if g.profiler_requested:
+        response.headers["X-Profile-Id"] = name
+    return response
+
+
+@app.teardown_request
+def discard_profiler(exc):
+    # after_request does not run when the response itself failed.
+    stop_profiler()
+
+
+profile_cli = AppGroup("profile", help="Request profiler commands.")
+
+
+@profile_cli.command("token")
+def profile_token_command():
+    """Print a token that makes a request profiled (send it as X-Profile or ?_profile=)."""
+    if not app.config["PROFILER_ENABLED"]:
+        click.echo("Note: PROFILER_ENABLED is off in this environment.", err=True)
+    click.echo(profiler_serializer().dumps("profile"))
+    minutes = app.config["PROFILE_TOKEN_MAX_AGE"] // 60
+    click.echo(f"Valid for {minutes} minutes.", err=True)
+
+
+@profile_cli.command("show")
+@click.argument("name")
+@click.option("--sort", default="cumulative", show_default=True, help="pstats sort key.")
+@click.option("--limit", default=30, show_default=True, help="Number of functions to print.")
+def profile_show_command(name, sort, limit):
+    """Print the top functions of a saved profile."""
+    path = name if os.path.isabs(name) else os.path.join(app.config["PROFILE_DIR"], name)
+    pstats.Stats(path).strip_dirs().sort_stats(sort).print_stats(limit)
+
+
+app.cli.add_command(profile_cli)
+
+
+# --- CACHES ---
+
+_MISSING = object()
+
+# name -> cache, so hit/miss counters can be reported in one place
+caches = {}
+
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU cache with an optional per-entry TTL."""
+
+    def __init__(self, name, maxsize, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        caches[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SQLiteCache:
+    """Same interface as LRUCache, stored in a local SQLite file so every
+    worker process on the machine shares the entries. Values must be JSON
+    serializable. Cache errors are counted as misses, never raised.
+
+    Hits only rewrite accessed_at once it is ACCESS_REFRESH seconds old, so
+    a hot key costs one write per interval instead of one per read; LRU
+    eviction is that coarse as a result.
+    """
+
+    ACCESS_REFRESH = 60
+
+    def __init__(self, name, path, maxsize, ttl=None):
+        self.name = name
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._pool = ConnectionPool(self._connect, 4)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        caches[name] = self
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute(f"PRAGMA busy_timeout = {int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache_entries (accessed_at)")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._pool.acquire()
+        try:
+            yield conn
+        finally:
+            self._pool.release(conn)
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            setattr(self, stat, getattr(self, stat) + n)
+
+    def get(self, key, default=None):
+        now = time.time()
+        try:
+            with self._connection() as conn:
+                row = conn.execute(
+                    "SELECT value, expires_at, accessed_at FROM cache_entries WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is None or (row[1] is not None and row[1] < now):
+                    self._count("misses")
+                    return default
+                if now - row[2] > self.ACCESS_REFRESH:
+                    conn.execute("UPDATE cache_entries SET accessed_at = ? WHERE key = ?", (now, key))
+            value = json.loads(row[0])
+        except (sqlite3.Error, ValueError):
+            self._count("misses")
+            return default
+        self._count("hits")
+        return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now + ttl if ttl else None, now),
+                )
+                conn.execute("DELETE FROM cache_entries WHERE expires_at < ?", (now,))
+                size = conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+                if size > self.maxsize:
+                    conn.execute(
+                        "DELETE FROM cache_entries WHERE key IN "
+                        "(SELECT key FROM cache_entries ORDER BY accessed_at LIMIT ?)",
+                        (size - self.maxsize,),
+                    )
+                    self._count("evictions", size - self.maxsize)
+        except sqlite3.Error:
+            pass
+
+    def invalidate(self, key):
+        try:
+            with self._connection() as conn:
+                conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        try:
+            with self._connection() as conn:
+                conn.execute("DELETE FROM cache_entries")
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        try:
+            with self._connection() as conn:
+                size = conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+        except sqlite3.Error:
+            size = None
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": size,
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def make_cache(name, backend, maxsize, ttl=None, path=None):
+    if backend == "none":
+        maxsize = 0
+    if backend == "sqlite":
+        return SQLiteCache(name, path, maxsize, ttl=ttl)
+    return LRUCache(name, maxsize, ttl=ttl)
+
+
+def cache_key(*parts) -> str:
+    return json.dumps(parts, separators=(",", ":"), ensure_ascii=False)
+
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+user_cache = LRUCache("user", app.config["USER_CACHE_SIZE"], ttl=app.config["USER_CACHE_TTL"])
+feed_cache = make_cache(
+    "feed",
+    app.config["FEED_CACHE_BACKEND"],
+    app.config["FEED_CACHE_SIZE"],
+    ttl=app.config["FEED_CACHE_TTL"],
+    path=app.config["FEED_CACHE_PATH"],
+)
+card_cache = LRUCache("card", app.config["CARD_CACHE_SIZE"])
+
+
+# --- UTILS ---
+
+def allowed_file(filename: str) -> bool:
+    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def save_uploaded_file(file_storage):
+    """Store an uploaded image under its content hash and return the filename or None.
+
+    The extension comes from the file's magic bytes, not its name; anything
+    that is not a PNG, JPEG or GIF is refused. Identical uploads get the same
+    name, so a repeat upload is not written again.
+    """
+    if not file_storage:
+        return None
+    if file_storage.filename == "":
+        return None
+    if not allowed_file(file_storage.filename):
+        return None
+
+    stream = file_storage.stream
+
+    if isinstance(stream, IncomingUpload):
+        # Already on disk, hashed and sniffed while the body was parsed.
+        ext = sniff_image_type(stream.head)
+        if ext is None:
+            return None
+        unique_name = f"{stream.hexdigest()}.{ext}"
+        stream.commit(upload_path(unique_name))
+        record_upload_metrics(stream.size)
+        return unique_name
+
+    stream.seek(0)
+    head = stream.read(SNIFF_BYTES)
+    ext = sniff_image_type(head)
+    if ext is None:
+        return None
+    digest = hashlib.sha256(head)
+    size = len(head)
+    for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+        digest.update(chunk)
+        size += len(chunk)
+    unique_name = f"{digest.hexdigest()}.{ext}"
+
+    filepath = upload_path(unique_name)
+    try:
+        os.utime(filepath)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        stream.seek(0)
+        tmp_path = f"{filepath}.{uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as out:
+            shutil.copyfileobj(stream, out, UPLOAD_CHUNK_SIZE)
+        os.replace(tmp_path, filepath)
+    record_upload_metrics(size)
+    return unique_name
+
+
+def upload_path(filename):
+    """Where an upload lives: UPLOAD_FOLDER/ab/cd/<filename>.
+
+    Content-addressed names shard on their own hash, so variants land next to
+    their original; older names shard on an MD5 of the name.
+    """
+    if HASH_PREFIXED_NAME.match(filename):
+        key = filename[:4]
+    else:
+        key = hashlib.md5(filename.encode()).hexdigest()[:4]
+    return os.path.join(app.config["UPLOAD_FOLDER"], key[:2], key[2:], filename)
+
+
+def locate_upload(filename):
+    """Path of an existing upload: sharded, or still flat if not migrated yet."""
+    path = upload_path(filename)
+    if not os.path.exists(path):
+        flat = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+        if os.path.exists(flat):
+            return flat
+    return path
+
+
+def upload_etag(filename):
+    """Content hash of a content-addressed upload, None for older uploads."""
+    match = CONTENT_ADDRESSED_NAME.match(filename)
+    return match.group(1) if match else None
+
+
+def acquire_upload(db, filename):
+    try:
+        size = os.path.getsize(locate_upload(filename))
+    except OSError:
+        size = None
+    db.execute(
+        """
+        INSERT INTO upload_blobs (filename, sha256, size, refcount, created_at)
+        VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT(filename) DO UPDATE SET refcount = refcount + 1
+        """,
+        (filename, upload_etag(filename), size, datetime.utcnow().isoformat()),
+    )
+
+
+def release_upload(db, filename):
+    """Drop one reference; the last one queues the file for deletion."""
+    row = db.execute(
+        "UPDATE upload_blobs SET refcount = MAX(refcount - 1, 0) WHERE filename = ? RETURNING refcount",
+        (filename,),
+    ).fetchone()
+    if row is not None and row[0] == 0:
+        enqueue_job(db, "delete_upload", {"filename": filename, "released_at": time.time()})
+
+
+def swap_upload(db, old_filename, new_filename):
+    """Move one reference from old_filename to new_filename (either may be None)."""
+    if old_filename == new_filename:
+        return
+    if new_filename:
+        acquire_upload(db, new_filename)
+    if old_filename:
+        release_upload(db, old_filename)
+
+
+def login_required(view):
+    @wraps(view)
+    def wrapped_view(**kwargs):
+        if "user_id" not in session:
+            flash("Please log in to access this page.", "warning")
+            return redirect(url_for("login", next=request.path))
+        return view(**kwargs)
+
+    return wrapped_view
+
+
+def get_current_user():
+    """Logged-in user's row, looked up at most once per request.
+
+    Rows are also kept in user_cache between requests; settings() drops
+    the entry when the profile changes, but only in its own worker, so the
+    row can be stale for up to USER_CACHE_TTL. Fine for rendering; writes
+    must re-read what they change inside their transaction.
+    """
+    user_id = session.get("user_id")
+    if not user_id:
+        return None
+    if g.get("current_user_id") == user_id:
+        return g.current_user
+
+    user = user_cache.get(user_id)
+    if user is None:
+        db = get_read_db()
+        user = db.execute(
+            "SELECT * FROM users WHERE id = ?",
+            (user_id,),
+        ).fetchone()
+        if user is not None:
+            user_cache.set(user_id, user)
+
+    g.current_user_id = user_id
+    g.current_user = user
+    return user
+
+
+def forget_current_user(user_id):
+    user_cache.invalidate(user_id)
+    if g.get("current_user_id") == user_id:
+        g.pop("current_user_id")
+        g.pop("current_user", None)
+
+
+@app.template_filter("tag_list")
+def parse_tags(text):
+    """'Flask, web,  flask' -> ['flask', 'web'] (lowercased, de-duplicated, in order)."""
+    tags = []
+    for tag in (text or "").split(","):
+        tag = " ".join(tag.split()).lower()
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+def set_item_tags(db, item_id, text):
+    """Store an item's comma-separated tags in tags / item_tags.
+
+    item_tags also keeps a copy of the item's visibility and created_at (the
+    feed sort key), so call this after the portfolio_items row is written.
+    """
+    db.execute("DELETE FROM item_tags WHERE item_id = ?", (item_id,))
+    for tag in parse_tags(text):
+        db.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
+        db.execute(
+            """
+            INSERT OR IGNORE INTO item_tags (tag_id, item_id, visibility, created_at)
+            SELECT t.id, p.id, p.visibility, p.created_at
+            FROM tags t, portfolio_items p
+            WHERE t.name = ? AND p.id = ?
+            """,
+            (tag, item_id),
+        )
+
+
+# --- FACETS ---
+
+def facet_values(item):
+    """Category and tags an item contributes to the facets (only public items count)."""
+    if item is None or item["visibility"] != "public":
+        return None, []
+    return item["category"] or None, parse_tags(item["tags"])
+
+
+def adjust_facet(db, table, column, value, delta):
+    db.execute(
+        f"""
+        INSERT INTO {table} ({column}, item_count) VALUES (?, ?)
+        ON CONFLICT({column}) DO UPDATE SET item_count = item_count + excluded.item_count
+        """,
+        (value, delta),
+    )
+    if delta < 0:
+        db.execute(f"DELETE FROM {table} WHERE {column} = ? AND item_count <= 0", (value,))
+
+
+def update_facets(db, old, new):
+    """Apply the facet change of one item going from `old` to `new` (either may be None)."""
+    old_category, old_tags = facet_values(old)
+    new_category, new_tags = facet_values(new)
+
+    if old_category != new_category:
+        if old_category:
+            adjust_facet(db, "category_facets", "category", old_category, -1)
+        if new_category:
+            adjust_facet(db, "category_facets", "category", new_category, 1)
+
+    for tag in old_tags:
+        if tag not in new_tags:
+            adjust_facet(db, "tag_facets", "tag", tag, -1)
+    for tag in new_tags:
+        if tag not in old_tags:
+            adjust_facet(db, "tag_facets", "tag", tag, 1)
+
+
+def rebuild_facets(db):
+    db.execute("DELETE FROM category_facets")
+    db.execute("DELETE FROM tag_facets")
+    db.execute(
+        """
+        INSERT INTO category_facets (category, item_count)
+        SELECT category, COUNT(*) FROM portfolio_items
+        WHERE visibility = 'public' AND category IS NOT NULL AND category != ''
+        GROUP BY category
+        """
+    )
+    tag_counts = {}
+    rows = db.execute("SELECT tags FROM portfolio_items WHERE visibility = 'public' AND tags != ''")
+    for row in rows:
+        for tag in parse_tags(row["tags"]):
+            tag_counts[tag] = tag_counts.get(tag, 0) + 1
+    db.executemany(
+        "INSERT INTO tag_facets (tag, item_count) VALUES (?, ?)",
+        tag_counts.items(),
+    )
+
+
+def load_facets(db, tag_limit=20):
+    categories = db.execute(
+        "SELECT category, item_count FROM category_facets ORDER BY category"
+    ).fetchall()
+    tags = db.execute(
+        "SELECT tag, item_count FROM tag_facets ORDER BY item_count DESC, tag LIMIT ?",
+        (tag_limit,),
+    ).fetchall()
+    return {
+        "categories": [dict(row) for row in categories],
+        "tags": [dict(row) for row in tags],
+    }
+
+
+# --- IMAGE VARIANTS ---
+
+def save_image(image, filename, fmt, **options):
+    # Write next to the target and rename, so a half-written variant is never served.
+    path = upload_path(filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid4().hex}.tmp"
+    image.save(tmp_path, fmt, **options)
+    os.replace(tmp_path, path)
+
+
+def generate_image_variants(filename, names):
+    """Write a resized JPEG/PNG and a WebP copy of an upload for each variant.
+
+    Returns {"card": {"w": 720, "h": 405, "img": "..._card.jpg", "webp": "..._card.webp"}, ...},
+    or None for images that are left as they are (animated GIFs).
+    """
+    stem = os.path.splitext(filename)[0]
+    with Image.open(locate_upload(filename)) as original:
+        if getattr(original, "is_animated", False):
+            return None
+        image = ImageOps.exif_transpose(original)
+        has_alpha = image.mode in ("RGBA", "LA") or (
+            image.mode == "P" and "transparency" in image.info
+        )
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+        variants = {}
+        for name in names:
+            thumb = image.copy()
+            thumb.thumbnail(IMAGE_VARIANTS[name], Image.LANCZOS)
+            img_name = f"{stem}_{name}.{'png' if has_alpha else 'jpg'}"
+            webp_name = f"{stem}_{name}.webp"
+            if has_alpha:
+                save_image(thumb, img_name, "PNG", optimize=True)
+            else:
+                save_image(thumb, img_name, "JPEG", quality=82, optimize=True, progressive=True)
+            save_image(thumb, webp_name, "WEBP", quality=80, method=4)
+            variants[name] = {"w": thumb.width, "h": thumb.height, "img": img_name, "webp": webp_name}
+    return variants
+
+
+def process_image_variants(filename, kind):
+    """Make the variants of an upload and store them on the rows that use it.
+
+    The data generation is left alone: cards are cached per image_variants and
+    profile ETags count the rows that have variants, so only pages showing
+    these rows change. The feed serves its full-size fallback for this image
+    until its cache entry expires or the next write bumps the generation.
+    """
+    names = AVATAR_IMAGE_VARIANTS if kind == "avatar" else ITEM_IMAGE_VARIANTS
+    try:
+        variants = generate_image_variants(filename, names)
+    except FileNotFoundError:
+        # Deleted (and released) before the job ran.
+        return
+    if not variants:
+        return
+    with write_transaction() as db:
+        if kind == "avatar":
+            db.execute(
+                "UPDATE users SET avatar_variants = ? WHERE avatar_filename = ?",
+                (json.dumps(variants), filename),
+            )
+        else:
+            db.execute(
+                "UPDATE portfolio_items SET image_variants = ? WHERE image_filename = ?",
+                (json.dumps(variants), filename),
+            )
+
+
+def known_image_variants(db, filename, kind):
+    """Variants already made for this (deduplicated) upload, if any."""
+    if kind == "avatar":
+        row = db.execute(
+            "SELECT avatar_variants FROM users WHERE avatar_filename = ? AND avatar_variants IS NOT NULL LIMIT 1",
+            (filename,),
+        ).fetchone()
+    else:
+        row = db.execute(
+            "SELECT image_variants FROM portfolio_items WHERE image_filename = ? AND image_variants IS NOT NULL LIMIT 1",
+            (filename,),
+        ).fetchone()
+    return row[0] if row else None
+
+
+def schedule_image_variants(db, filename, kind):
+    """Queue variant generation for an upload ("item" or "avatar").
+
+    Call it in the write transaction that stores the upload: the
+    generate_variants job then exists exactly when the upload does.
+    """
+    if not filename or Image is None or not app.config["IMAGE_PIPELINE"]:
+        return
+    enqueue_job(db, "generate_variants", {"filename": filename, "kind": kind})
+
+
+@app.template_global()
+def image_sources(filename, variants_json, names):
+    """src and srcset values for an upload; the srcsets stay None until variants exist."""
+    sources = {
+        "src": url_for("uploaded_file", filename=filename),
+        "srcset": None,
+        "webp_srcset": None,
+    }
+    if not variants_json:
+        return sources
+    try:
+        variants = json.loads(variants_json)
+    except ValueError:
+        return sources
+    available = [variants[name] for name in names if name in variants]
+    if available:
+        sources["srcset"] = ", ".join(
+            f"{url_for('uploaded_file', filename=v['img'])} {v['w']}w" for v in available
+        )
+        sources["webp_srcset"] = ", ".join(
+            f"{url_for('uploaded_file', filename=v['webp'])} {v['w']}w" for v in available
+        )
+    return sources
+
+
+# --- CARD FRAGMENTS ---
+
+# Stands in for the CSRF token inside cached cards; the viewer's own token is
+# swapped in on every render. Random per process, so item text cannot fake it.
+CARD_CSRF_PLACEHOLDER = f"csrf-{uuid4().hex}"
+
+# Card kind -> macro in _cards.html. "owner" cards carry edit/delete controls.
+CARD_MACROS = {"feed": "feed_card", "owner": "owner_card", "public": "public_card"}
+
+
+def card_version(kind, item):
+    """Everything except the language that can change a card's markup."""
+    version = (item.id, item.updated_at, item.image_filename, item.image_variants)
+    if kind == "feed":
+        # Feed cards also show the author's name and avatar.
+        version += (item.author_updated_at, item.avatar_filename, item.avatar_variants)
+    return version
+
+
+@app.template_global()
+def render_card(kind, item):
+    """A portfolio card, rendered once per item version, language and kind.
+
+    Edits bump updated_at (of the item, or of the author in settings), which
+    changes the key; the superseded entries simply age out of the LRU.
+    """
+    lang = get_locale()
+    key = (kind, lang) + card_version(kind, item)
+    html = card_cache.get(key)
+    if html is None:
+        macro = get_template_attribute("_cards.html", CARD_MACROS[kind])
+        html = str(macro(item, translator(lang), CARD_CSRF_PLACEHOLDER))
+        card_cache.set(key, html)
+    if kind == "owner":
+        html = html.replace(CARD_CSRF_PLACEHOLDER, generate_csrf_token())
+    return Markup(html)
+
+
+# --- UPLOAD LAYOUT ---
+
+def iter_flat_uploads(folder):
+    """Files still sitting directly in UPLOAD_FOLDER (the layout before sharding)."""
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or entry.name.endswith((".tmp", ".part")):
+                continue
+            if entry.is_file(follow_symlinks=False):
+                yield entry.name
+
+
+def upload_is_referenced(db, filename):
+    return db.execute(
+        """
+        SELECT EXISTS (SELECT 1 FROM users WHERE avatar_filename = ?)
+            OR EXISTS (SELECT 1 FROM portfolio_items WHERE image_filename = ?)
+        """,
+        (filename, filename),
+    ).fetchone()[0]
+
+
+def hash_upload_file(path):
+    """(sha256 hex, sniffed extension or None) of a file on disk."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_BYTES)
+        digest.update(head)
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest(), sniff_image_type(head)
+
+
+def shard_flat_upload(filename):
+    flat = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    target = upload_path(filename)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.exists(target):
+        # Same name means same bytes: content hash, or a unique legacy name.
+        os.unlink(flat)
+    else:
+        os.replace(flat, target)
+
+
+def rename_upload(db, old_filename, new_filename, sha256, size):
+    """Point every reference to old_filename at new_filename, moving its refcount along.
+
+    The rows' updated_at moves too, so cached cards and page ETags keyed on
+    it are invalidated in every worker, not just this process.
+    """
+    now = datetime.utcnow().isoformat()
+    moved = db.execute(
+        "UPDATE users SET avatar_filename = ?, updated_at = ? WHERE avatar_filename = ?",
+        (new_filename, now, old_filename),
+    ).rowcount
+    moved += db.execute(
+        "UPDATE portfolio_items SET image_filename = ?, updated_at = ? WHERE image_filename = ?",
+        (new_filename, now, old_filename),
+    ).rowcount
+    if moved:
+        db.execute(
+            """
+            INSERT INTO upload_blobs (filename, sha256, size, refcount, created_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(filename) DO UPDATE SET
+                refcount = refcount + excluded.refcount,
+                sha256 = excluded.sha256,
+                size = excluded.size
+            """,
+            (new_filename, sha256, size, moved, datetime.utcnow().isoformat()),
+        )
+        db.execute(
+            "UPDATE upload_blobs SET refcount = MAX(refcount - ?, 0) WHERE filename = ?",
+            (moved, old_filename),
+        )
+    db.execute("DELETE FROM upload_blobs WHERE filename = ? AND refcount = 0", (old_filename,))
+    return moved
+
+
+def copy_upload(source, filename):
+    """Copy an existing file to upload_path(filename) unless it is already there."""
+    target = upload_path(filename)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f"{target}.{uuid4().hex}.tmp"
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+    return target
+
+
+def renamed_variants(variants_json, old_stem, new_stem):
+    """variants_json with its <old_stem>_* files copied to <new_stem>_*, or None if one is missing."""
+    try:
+        variants = json.loads(variants_json)
+        for variant in variants.values():
+            for key in ("img", "webp"):
+                name = variant[key]
+                if name.startswith(f"{old_stem}_"):
+                    variant[key] = f"{new_stem}{name[len(old_stem):]}"
+                    copy_upload(locate_upload(name), variant[key])
+    except (ValueError, AttributeError, KeyError, FileNotFoundError):
+        return None
+    return json.dumps(variants)
+
+
+def rename_upload_variants(db, old_filename, new_filename):
+    """Move the variants of a renamed upload to the new stem, ahead of rename_upload().
+
+    The old-stem files stay until remove_renamed_upload deletes them with the
+    original. Rows whose variant files are gone lose their variants; returns
+    the kinds ("avatar", "item") that need generating again.
+    """
+    old_stem = os.path.splitext(old_filename)[0]
+    new_stem = os.path.splitext(new_filename)[0]
+    regenerate = []
+    for kind, select_sql, update_sql in (
+        (
+            "avatar",
+            "SELECT DISTINCT avatar_variants FROM users WHERE avatar_filename = ? AND avatar_variants IS NOT NULL",
+            "UPDATE users SET avatar_variants = ? WHERE avatar_filename = ? AND avatar_variants = ?",
+        ),
+        (
+            "item",
+            "SELECT DISTINCT image_variants FROM portfolio_items WHERE image_filename = ? AND image_variants IS NOT NULL",
+            "UPDATE portfolio_items SET image_variants = ? WHERE image_filename = ? AND image_variants = ?",
+        ),
+    ):
+        for (variants_json,) in db.execute(select_sql, (old_filename,)).fetchall():
+            renamed = renamed_variants(variants_json, old_stem, new_stem)
+            db.execute(update_sql, (renamed, old_filename, variants_json))
+            if renamed is None and kind not in regenerate:
+                regenerate.append(kind)
+    return regenerate
+
+
+def migrate_upload_batch(names):
+    """Move one batch of flat files into the sharded layout.
+
+    Referenced images with a legacy <name>_<uuid> name are re-stored under
+    their content hash and the rows pointing at them, variants included, are
+    rewritten in a single transaction. The old file and its variants are
+    sharded like the rest and kept until a delayed remove_renamed_upload job
+    runs: web workers may still hold rows from before the rename in
+    user_cache, and browsers in pages, for a while.
+    Returns (files moved, files renamed).
+    """
+    folder = app.config["UPLOAD_FOLDER"]
+    db = get_read_db()
+    moved = 0
+    renames = []
+    for name in names:
+        flat = os.path.join(folder, name)
+        if not HASH_PREFIXED_NAME.match(name) and upload_is_referenced(db, name):
+            sha256, ext = hash_upload_file(flat)
+            if ext is not None:
+                new_name = f"{sha256}.{ext}"
+                target = copy_upload(flat, new_name)
+                renames.append((name, new_name, sha256, os.path.getsize(target)))
+                continue
+        shard_flat_upload(name)
+        moved += 1
+
+    if renames:
+        with write_transaction() as db:
+            for old_name, new_name, sha256, size in renames:
+                for kind in rename_upload_variants(db, old_name, new_name):
+                    schedule_image_variants(db, new_name, kind)
+                rename_upload(db, old_name, new_name, sha256, size)
+                enqueue_job(db, "remove_renamed_upload", {"filename": old_name}, delay=RENAMED_UPLOAD_GRACE)
+            bump_data_generation(db)
+        for old_name, *_ in renames:
+            shard_flat_upload(old_name)
+            # A fresh mtime keeps `uploads gc` off it (and its variants)
+            # during the grace period too.
+            for path in [upload_path(old_name)] + upload_variant_paths(old_name):
+                os.utime(path)
+    return moved + len(renames), len(renames)
+
+
+# How long a legacy file outlives its rename; longer than USER_CACHE_TTL and
+# any sane PUBLIC_PAGE_MAX_AGE, so nothing still links to it when it goes.
+RENAMED_UPLOAD_GRACE = 3600
+
+
+uploads_cli = AppGroup("uploads", help="Upload storage commands.")
+
+
+@uploads_cli.command("migrate")
+@click.option("--batch-size", default=200, show_default=True, help="Files per transaction.")
+def migrate_uploads_command(batch_size):
+    """Move flat uploads into the sharded layout. Safe to interrupt and re-run."""
+    total = renamed = 0
+    names = iter_flat_uploads(app.config["UPLOAD_FOLDER"])
+    while True:
+        batch = list(islice(names, batch_size))
+        if not batch:
+            break
+        batch_moved, batch_renamed = migrate_upload_batch(batch)
+        total += batch_moved
+        renamed += batch_renamed
+        click.echo(f"{total} files moved ({renamed} renamed to their content hash)...")
+    click.echo(f"Done: {total} files moved, {renamed} renamed.")
+
+
+# Image variants (<stem>_card.jpg ...) live exactly as long as their original does.
+VARIANT_NAME = re.compile(r"^(.+)_(?:%s)\.(?:jpg|png|webp)$" % "|".join(IMAGE_VARIANTS))
+UPLOADS_GC_TASK = "uploads_gc"
+
+
+def load_task_position(db, task):
+    row = db.execute("SELECT position FROM task_progress WHERE task = ?", (task,)).fetchone()
+    return row[0] if row else None
+
+
+def save_task_position(db, task, position):
+    db.execute(
+        """
+        INSERT INTO task_progress (task, position, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(task) DO UPDATE SET position = excluded.position, updated_at = excluded.updated_at
+        """,
+        (task, position, datetime.utcnow().isoformat()),
+    )
+
+
+def upload_owners(filename):
+    """Names whose reference keeps `filename` on disk; [] for leftover temp files.
+
+    A variant belongs to its original, whatever the stem: `uploads migrate`
+    moves the variants of legacy uploads along with them.
+    """
+    if filename.endswith(".tmp"):
+        return []
+    match = VARIANT_NAME.match(filename)
+    if match is None:
+        return [filename]
+    stem = match.group(1)
+    return [f"{stem}.{ext}" for ext in sorted(ALLOWED_EXTENSIONS)]
+
+
+def referenced_uploads(db, names):
+    """The subset of `names` used as an avatar or a portfolio image."""
+    names = list(names)
+    if not names:
+        return set()
+    placeholders = ",".join("?" * len(names))
+    rows = db.execute(
+        f"""
+        SELECT avatar_filename FROM users WHERE avatar_filename IN ({placeholders})
+        UNION
+        SELECT image_filename FROM portfolio_items WHERE image_filename IN ({placeholders})
+        """,
+        names + names,
+    ).fetchall()
+    return {row[0] for row in rows}
+
+
+def iter_upload_dirs(folder):
+    """Directories to sweep, in a stable order: the flat top level, then every ab/cd shard."""
+    yield ""
+    for top in sorted(e.name for e in os.scandir(folder) if e.is_dir() and not e.name.startswith(".")):
+        top_path = os.path.join(folder, top)
+        for sub in sorted(e.name for e in os.scandir(top_path) if e.is_dir()):
+            yield f"{top}/{sub}"
+
+
+def iter_file_batches(path, batch_size):
+    with os.scandir(path) as entries:
+        batch = []
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+
+def sweep_upload_batch(directory, entries, cutoff, dry_run):
+    """Delete the unreferenced files in one batch. Returns [(name, size)] of orphans found.
+
+    References are looked up once to find candidates, then again inside a
+    write transaction right before unlinking, so a request that starts using
+    one of them in the meantime (and refreshes its mtime) keeps it.
+    """
+    candidates = []
+    for entry in entries:
+        stat = entry.stat(follow_symlinks=False)
+        if stat.st_mtime >= cutoff:
+            continue
+        candidates.append((entry.name, stat.st_size, upload_owners(entry.name)))
+    if not candidates:
+        return []
+
+    def unreferenced(db):
+        referenced = referenced_uploads(db, {owner for _, _, owners in candidates for owner in owners})
+        return [(name, size) for name, size, owners in candidates if not referenced.intersection(owners)]
+
+    if dry_run:
+        return unreferenced(get_read_db())
+
+    orphans = []
+    with write_transaction() as db:
+        for name, size in unreferenced(db):
+            path = os.path.join(directory, name)
+            try:
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            db.execute("DELETE FROM upload_blobs WHERE filename = ?", (name,))
+            orphans.append((name, size))
+    return orphans
+
+
+def sweep_incoming(folder, cutoff, dry_run):
+    """Remove upload parts abandoned by crashed or killed requests."""
+    incoming = os.path.join(folder, ".incoming")
+    if not os.path.isdir(incoming):
+        return 0
+    removed = 0
+    for batch in iter_file_batches(incoming, 500):
+        for entry in batch:
+            if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                if not dry_run:
+                    os.unlink(entry.path)
+                removed += 1
+    return removed
+
+
+@uploads_cli.command("gc")
+@click.option("--grace-hours", default=24, show_default=True, help="Never delete files younger than this.")
+@click.option("--batch-size", default=500, show_default=True, help="Files checked per query.")
+@click.option("--dry-run", is_flag=True, help="Only list what would be deleted.")
+@click.option("--restart", is_flag=True, help="Ignore saved progress and sweep from the start.")
+def gc_uploads_command(grace_hours, batch_size, dry_run, restart):
+    """Delete uploads no avatar or portfolio item uses any more.
+
+    Progress is saved after each shard directory, so an interrupted run
+    resumes where it stopped; a finished run starts over next time.
+    """
+    folder = app.config["UPLOAD_FOLDER"]
+    cutoff = time.time() - grace_hours * 3600
+    resume_after = None if restart else load_task_position(get_read_db(), UPLOADS_GC_TASK)
+    if resume_after is not None:
+        click.echo(f"Resuming after {resume_after or 'the top level'}.")
+
+    parts = sweep_incoming(folder, cutoff, dry_run)
+    deleted = freed = 0
+    for relative_dir in iter_upload_dirs(folder):
+        if resume_after is not None and relative_dir <= resume_after:
+            continue
+        directory = os.path.join(folder, relative_dir)
+        for batch in iter_file_batches(directory, batch_size):
+            for name, size in sweep_upload_batch(directory, batch, cutoff, dry_run):
+                if dry_run:
+                    click.echo(os.path.join(relative_dir, name))
+                deleted += 1
+                freed += size
+        if not dry_run:
+            with write_transaction() as db:
+                save_task_position(db, UPLOADS_GC_TASK, relative_dir)
+
+    if not dry_run:
+        with write_transaction() as db:
+            db.execute("DELETE FROM task_progress WHERE task = ?", (UPLOADS_GC_TASK,))
+    verb = "Would delete" if dry_run else "Deleted"
+    click.echo(f"{verb} {deleted} orphaned files ({freed / 1024 / 1024:.1f} MB) and {parts} stale upload parts.")
+
+
+app.cli.add_command(uploads_cli)
+
+
+# --- BACKGROUND JOBS ---
+
+# kind -> handler(payload); registered with @job_handler
+JOB_HANDLERS = {}
+
+
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def enqueue_job(db, kind, payload, delay=0):
+    """Queue a job. Call it inside the write transaction whose changes it follows up on,
+    so the job exists exactly when those changes were committed."""
+    db.execute(
+        "INSERT INTO jobs (kind, payload, run_at, created_at) VALUES (?, ?, ?, ?)",
+        (kind, json.dumps(payload), time.time() + delay, datetime.utcnow().isoformat()),
+    )
+
+
+def claim_job():
+    """Take the next due job, or None.
+
+    Claiming pushes run_at out by the visibility timeout: if this worker dies
+    mid-job, the job simply becomes due again for someone else.
+    """
+    now = time.time()
+    with write_transaction() as db:
+        row = db.execute(
+            """
+            UPDATE jobs SET run_at = ?, attempts = attempts + 1
+            WHERE id = (
+                SELECT id FROM jobs WHERE state = 'pending' AND run_at <= ?
+                ORDER BY run_at LIMIT 1
+            )
+            RETURNING id, kind, payload, attempts
+            """,
+            (now + app.config["JOB_VISIBILITY_TIMEOUT"], now),
+        ).fetchone()
+    return row
+
+
+def finish_job(job_id):
+    with write_transaction() as db:
+        db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
 
 
-def get_locale():
-    code = session.get("lang", "en")
-    if code not in LANGUAGES:
-        code = "en"
-    return code
+def fail_job(job_id, attempts, error):
+    if attempts >= app.config["JOB_MAX_ATTEMPTS"]:
+        state, run_at = "dead", time.time()
+    else:
+        state, run_at = "pending", time.time() + app.config["JOB_RETRY_DELAY"] * 2 ** (attempts - 1)
+    with write_transaction() as db:
+        db.execute(
+            "UPDATE jobs SET state = ?, run_at = ?, last_error = ? WHERE id = ?",
+            (state, run_at, error, job_id),
+        )
+    return state
+
+
+def run_next_job():
+    """Claim and run one job. Returns False when nothing is due."""
+    job = claim_job()
+    if job is None:
+        return False
+    handler = JOB_HANDLERS.get(job["kind"])
+    try:
+        if handler is None:
+            raise LookupError(f"No handler for job kind {job['kind']!r}")
+        handler(json.loads(job["payload"]))
+    except Exception as exc:
+        state = fail_job(job["id"], job["attempts"], f"{type(exc).__name__}: {exc}")
+        app.logger.exception("Job %s (%s) failed, now %s", job["id"], job["kind"], state)
+    else:
+        finish_job(job["id"])
+    return True
+
+
+def upload_variant_paths(filename):
+    """Existing variant files of an upload, sharded or still flat."""
+    stem = os.path.splitext(filename)[0]
+    paths = []
+    for name in IMAGE_VARIANTS:
+        for ext in ("jpg", "png", "webp"):
+            path = locate_upload(f"{stem}_{name}.{ext}")
+            if os.path.exists(path):
+                paths.append(path)
+    return paths
+
+
+def remove_upload_variants(filename):
+    for path in upload_variant_paths(filename):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+@job_handler("generate_variants")
+def generate_variants_job(payload):
+    process_image_variants(payload["filename"], payload["kind"])
+
+
+@job_handler("delete_upload")
+def delete_upload_job(payload):
+    """Remove an upload and its variants once nothing references it any more."""
+    filename = payload["filename"]
+    with write_transaction() as db:
+        row = db.execute("SELECT refcount FROM upload_blobs WHERE filename = ?", (filename,)).fetchone()
+        if (row is not None and row[0] > 0) or referenced_uploads(db, [filename]):
+            return
+        path = locate_upload(filename)
+        try:
+            if os.stat(path).st_mtime > payload["released_at"]:
+                # Uploaded again since it was released; a new reference is on its way.
+                return
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        remove_upload_variants(filename)
+        db.execute("DELETE FROM upload_blobs WHERE filename = ? AND refcount = 0", (filename,))
+
+
+@job_handler("remove_renamed_upload")
+def remove_renamed_upload_job(payload):
+    """Remove the legacy original of an upload that `uploads migrate` renamed,
+    with its old-stem variants (the rows moved to copies under the new stem)."""
+    filename = payload["filename"]
+    with write_transaction() as db:
+        if referenced_uploads(db, [filename]):
+            return
+        try:
+            os.unlink(locate_upload(filename))
+        except FileNotFoundError:
+            pass
+        remove_upload_variants(filename)
+
+
+jobs_cli = AppGroup("jobs", help="Background job queue commands.")
+
+
+@jobs_cli.command("work")
+@click.option("--burst", is_flag=True, help="Exit once no job is due instead of waiting.")
+@click.option("--poll-interval", default=1.0, show_default=True, help="Seconds to sleep when idle.")
+def work_jobs_command(burst, poll_interval):
+    """Run queued jobs until stopped (SIGTERM / Ctrl-C finish the current job first)."""
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    done = 0
+    while not stopping:
+        if run_next_job():
+            done += 1
+        elif burst:
+            break
+        else:
+            time.sleep(poll_interval)
+    click.echo(f"Worker stopped after {done} jobs.")
 
 
-def t(key: str) -> str:
-    lang = get_locale()
-    return translations.get(lang, {}).get(key, translations["en"].get(key, key))
+@jobs_cli.command("status")
+def jobs_status_command():
+    """Count queued and dead jobs by kind."""
+    rows = get_read_db().execute(
+        """
+        SELECT kind, state, COUNT(*) AS n, SUM(run_at <= ?) AS due FROM jobs
+        GROUP BY kind, state ORDER BY kind, state
+        """,
+        (time.time(),),
+    ).fetchall()
+    if not rows:
+        click.echo("No jobs.")
+    for row in rows:
+        due = f" ({row['due']} due)" if row["state"] == "pending" else ""
+        click.echo(f"{row['kind']:<20} {row['state']:<8} {row['n']}{due}")
 
-app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret-key-change-me")
-app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
-app.config["MAX_CONTENT_LENGTH"] = 2 * 1024 * 1024  # 2 MB
-app.permanent_session_lifetime = timedelta(days=30)
 
-os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+@jobs_cli.command("retry-dead")
+def retry_dead_jobs_command():
+    """Give dead jobs a fresh set of attempts."""
+    with write_transaction() as db:
+        count = db.execute(
+            "UPDATE jobs SET state = 'pending', attempts = 0, run_at = ? WHERE state = 'dead'",
+            (time.time(),),
+        ).rowcount
+    click.echo(f"Requeued {count} jobs.")
 
 
-# --- DATABASE HELPERS ---
+app.cli.add_command(jobs_cli)
 
-def get_db():
-    if "db" not in g:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        g.db = conn
-    return g.db
 
+# --- PAGINATION ---
 
-@app.teardown_appcontext
-def close_db(exc):
-    db = g.pop("db", None)
-    if db is not None:
-        db.close()
+Page = namedtuple("Page", ["items", "next_cursor", "prev_cursor"])
 
+# Keyset orderings: (sql expression, row key, descending)
+FEED_ORDER = [("p.created_at", "created_at", True), ("p.id", "id", True)]
+ITEMS_ORDER = [("created_at", "created_at", True), ("id", "id", True)]
+# Tag-filtered feed: walks item_tags' own copy of the sort key
+TAG_FEED_ORDER = [("it.created_at", "created_at", True), ("it.item_id", "id", True)]
 
-def init_db():
-    db = get_db()
-    # Users table
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            full_name TEXT NOT NULL,
-            username TEXT NOT NULL UNIQUE,
-            email TEXT NOT NULL UNIQUE,
-            password_hash TEXT NOT NULL,
-            bio TEXT,
-            location TEXT,
-            website TEXT,
-            linkedin TEXT,
-            github TEXT,
-            profession TEXT,
-            avatar_filename TEXT,
-            created_at TEXT NOT NULL
-        );
-        """
-    )
 
-    # Portfolio items table
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS portfolio_items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            description TEXT,
-            category TEXT,
-            tags TEXT,
-            external_link TEXT,
-            image_filename TEXT,
-            visibility TEXT NOT NULL DEFAULT 'public',
-            created_at TEXT NOT NULL,
-            updated_at TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-        """
-    )
+def encode_cursor(values) -> str:
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
 
-    db.commit()
 
+def decode_cursor(token, size):
+    """Return the key values in a cursor, or None if it is missing or malformed."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            return None
+    return values
+
+
+def keyset_condition(order, values, backwards=False):
+    ops = ["<" if desc != backwards else ">" for _, _, desc in order]
+    if len(set(ops)) == 1:
+        # Same direction on every key -> row value comparison, which SQLite
+        # can turn into an index range scan.
+        columns = ", ".join(expr for expr, _, _ in order)
+        marks = ", ".join("?" for _ in order)
+        return f"({columns}) {ops[0]} ({marks})", list(values)
+
+    terms = []
+    params = []
+    for i, (expr, _, _) in enumerate(order):
+        parts = [f"{order[j][0]} = ?" for j in range(i)]
+        parts.append(f"{expr} {ops[i]} ?")
+        terms.append("(" + " AND ".join(parts) + ")")
+        params.extend(values[:i])
+        params.append(values[i])
+    return "(" + " OR ".join(terms) + ")", params
 
-# ❗ MUHIM: Flask 3 da before_first_request yo‘q, shuning uchun
-# app kontekstida init_db() ni modul yuklanganda bir marta chaqiramiz.
-with app.app_context():
-    init_db()
 
+def keyset_page(db, sql, params, order, after=None, before=None, per_page=FEED_PER_PAGE):
+    """Run `sql` (which must end inside a WHERE clause) one page at a time.
 
-# --- CSRF PROTECTION ---
+    Pages are addressed by the sort key of the row next to them rather
+    than by OFFSET, so page 1000 costs the same as page 1.
+    """
+    return union_keyset_page(db, [(sql, params)], order, after=after, before=before, per_page=per_page)
 
-def generate_csrf_token():
-    token = session.get("csrf_token")
-    if not token:
-        token = uuid4().hex
-        session["csrf_token"] = token
-    return token
 
+def union_keyset_page(db, queries, order, after=None, before=None, per_page=FEED_PER_PAGE):
+    """keyset_page over the union of several (sql, params) queries.
 
-@app.before_request
-def csrf_protect():
-    # Only check for POST
-    if request.method == "POST":
-        token = session.get("csrf_token", None)
-        form_token = request.form.get("csrf_token") or request.headers.get("X-CSRFToken")
-        if not token or not form_token or token != form_token:
-            abort(400, description="Invalid CSRF token")
+    The queries must select the same columns and share `order` (all in one
+    direction). Each one is paged on its own, so the page still costs at most
+    one page of rows per query; rows found by several queries appear once.
+    """
+    backwards = before is not None and after is None
+    cursor = before if backwards else after
+
+    def key(row):
+        return [row[name] for _, name, _ in order]
+
+    rows = []
+    for sql, params in queries:
+        params = list(params)
+        if cursor is not None:
+            clause, clause_params = keyset_condition(order, cursor, backwards)
+            sql += " AND " + clause
+            params.extend(clause_params)
+
+        sql += " ORDER BY " + ", ".join(
+            f"{expr} {'DESC' if desc != backwards else 'ASC'}" for expr, _, desc in order
+        )
+        sql += " LIMIT ?"
+        params.append(per_page + 1)  # Fetch one extra to see if there's another page
+        rows.extend(db.execute(sql, params).fetchall())
+
+    if len(queries) > 1:
+        assert len({desc for _, _, desc in order}) == 1, "union pages need one sort direction"
+        unique = {tuple(key(row)): row for row in rows}
+        rows = sorted(unique.values(), key=key, reverse=order[0][2] != backwards)
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor is not None, has_more
+
+    return Page(
+        items=rows,
+        next_cursor=encode_cursor(key(rows[-1])) if rows and has_next else None,
+        prev_cursor=encode_cursor(key(rows[0])) if rows and has_prev else None,
+    )
 
 
-@app.route("/set-lang/<lang_code>")
-def set_language(lang_code):
-    if lang_code not in LANGUAGES:
-        lang_code = "en"
-    session["lang"] = lang_code
-    next_url = request.referrer or url_for("index")
-    return redirect(next_url)
+def page_cursors(order):
+    """Read ?after= / ?before= cursors for the given ordering."""
+    after = decode_cursor(request.args.get("after"), len(order))
+    before = decode_cursor(request.args.get("before"), len(order))
+    return after, before
 
 
-@app.context_processor
-def inject_globals():
-    return {
-        "current_user": get_current_user(),
-        "csrf_token": generate_csrf_token,
-        "t": t,
-        "current_lang": get_locale(),
-        "languages": LANGUAGES,
-    }
+# --- LISTINGS ---
 
+# Listing pages select only the columns their cards show and keep each row
+# as a small namedtuple. The full description is read only where it is shown.
 
-# --- UTILS ---
+def description_excerpt(description):
+    """Start of a description as listing cards show it; stored on every write."""
+    if description and len(description) > EXCERPT_LENGTH:
+        return description[:EXCERPT_LENGTH] + "..."
+    return description
 
-def allowed_file(filename: str) -> bool:
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+FeedCard = namedtuple(
+    "FeedCard",
+    [
+        "id", "title", "description_excerpt", "category", "tags", "image_filename", "image_variants",
+        "created_at", "updated_at",
+        "username", "full_name", "avatar_filename", "avatar_variants", "author_updated_at",
+    ],
+)
+FEED_COLUMNS = """
+    p.id, p.title, p.description_excerpt, p.category, p.tags, p.image_filename, p.image_variants,
+    p.created_at, p.updated_at,
+    u.username, u.full_name, u.avatar_filename, u.avatar_variants, u.updated_at AS author_updated_at
+"""
+
+OwnerCard = namedtuple(
+    "OwnerCard",
+    [
+        "id", "title", "description_excerpt", "category", "tags", "external_link",
+        "image_filename", "image_variants", "visibility", "created_at", "updated_at",
+    ],
+)
+OWNER_COLUMNS = ", ".join(OwnerCard._fields)
+
+PublicCard = namedtuple(
+    "PublicCard",
+    [
+        "id", "title", "description", "category", "tags", "external_link",
+        "image_filename", "image_variants", "created_at", "updated_at",
+    ],
+)
+PUBLIC_COLUMNS = ", ".join(PublicCard._fields)
 
-def save_uploaded_file(file_storage):
-    """Save uploaded image to uploads folder and return filename or None."""
-    if not file_storage:
-        return None
-    if file_storage.filename == "":
-        return None
-    if not allowed_file(file_storage.filename):
-        return None
 
-    filename = secure_filename(file_storage.filename)
-    # Make filename unique
-    name, ext = os.path.splitext(filename)
-    unique_name = f"{name}_{uuid4().hex}{ext}"
-    filepath = os.path.join(app.config["UPLOAD_FOLDER"], unique_name)
-    file_storage.save(filepath)
-    return unique_name
+def listing(rows, view):
+    """`rows` as `view` tuples; trailing extra columns (a search rank) are dropped."""
+    size = len(view._fields)
+    return [view._make(row[:size]) for row in rows]
 
 
-def login_required(view):
-    @wraps(view)
-    def wrapped_view(**kwargs):
-        if "user_id" not in session:
-            flash("Please log in to access this page.", "warning")
-            return redirect(url_for("login", next=request.path))
-        return view(**kwargs)
+# --- FEED ---
 
-    return wrapped_view
+def get_data_generation(db) -> int:
+    """Counter bumped by every write that can change the public feed.
 
+    It lives in the database, so all workers see a bump at once and cached
+    feed pages from older generations are simply never looked up again.
+    """
+    row = db.execute("SELECT value FROM app_state WHERE key = 'data_generation'").fetchone()
+    return row[0] if row else 0
 
-def get_current_user():
-    user_id = session.get("user_id")
-    if not user_id:
-        return None
-    db = get_db()
-    user = db.execute(
-        "SELECT * FROM users WHERE id = ?",
-        (user_id,),
-    ).fetchone()
-    return user
 
+def get_data_changed_at(db) -> int:
+    """Unix time of the last bump_data_generation(), for Last-Modified headers."""
+    row = db.execute("SELECT value FROM app_state WHERE key = 'data_changed_at'").fetchone()
+    return row[0] if row else 0
 
-# --- ROUTES ---
 
-@app.route("/")
-def index():
-    db = get_db()
-    q = request.args.get("q", "").strip()
-    category = request.args.get("category", "").strip()
-    page = int(request.args.get("page", 1))
-    per_page = 9
-    offset = (page - 1) * per_page
-
-    sql = """
-        SELECT p.*, u.username, u.full_name, u.avatar_filename
-        FROM portfolio_items p
-        JOIN users u ON p.user_id = u.id
-        WHERE p.visibility = 'public'
+def bump_data_generation(db):
+    db.execute("UPDATE app_state SET value = value + 1 WHERE key = 'data_generation'")
+    db.execute(
+        "UPDATE app_state SET value = CAST(strftime('%s', 'now') AS INTEGER) WHERE key = 'data_changed_at'"
+    )
+
+
+def feed_query(q, category, tags=(), tag_mode="all"):
+    """Queries and keyset ordering for the public feed.
+
+    Returns ([(sql, params), ...], order) for union_keyset_page(). Only "any"
+    of several tags needs more than one query. With tags (and no full-text
+    match) each query walks one tag's run of item_tags in feed order, so a
+    page costs the same however many items carry the tag; "all" walks the
+    first tag and checks the others per row, so pass the rarest first.
     """
-    params = []
+    match = build_match_query(q) if q and HAS_FTS5 else None
+
+    if match:
+        weights = ", ".join(str(w) for w in SEARCH_WEIGHTS)
+        rank = f"bm25(portfolio_search, {weights})"
+        sql = f"""
+            SELECT {FEED_COLUMNS}, {rank} AS search_rank
+            FROM portfolio_search
+            JOIN portfolio_items p ON p.id = portfolio_search.rowid
+            JOIN users u ON p.user_id = u.id
+            WHERE portfolio_search MATCH ? AND p.visibility = 'public'
+        """
+        params = [match]
+        order = [(rank, "search_rank", False)] + FEED_ORDER
+    elif tags:
+        sql = f"""
+            SELECT {FEED_COLUMNS}
+            FROM item_tags it
+            JOIN portfolio_items p ON p.id = it.item_id
+            JOIN users u ON p.user_id = u.id
+            WHERE it.tag_id = (SELECT id FROM tags WHERE name = ?) AND it.visibility = 'public'
+        """
+        params = []  # the walked tag goes first, added below
+        order = TAG_FEED_ORDER
+    else:
+        sql = f"""
+            SELECT {FEED_COLUMNS}
+            FROM portfolio_items p
+            JOIN users u ON p.user_id = u.id
+            WHERE p.visibility = 'public'
+        """
+        params = []
+        order = FEED_ORDER
 
-    if q:
+    if q and not match:
+        # Substring fallback (no FTS5, or a query with no word characters)
         sql += """
         AND (
             LOWER(u.username) LIKE ?
@@ -468,26 +3317,146 @@ def index():
         sql += " AND p.category = ?"
         params.append(category)
 
-    sql += " ORDER BY p.created_at DESC LIMIT ? OFFSET ?"
-    params.extend([per_page + 1, offset])  # Fetch one extra to see if there's next page
+    if not tags:
+        return [(sql, params)], order
+
+    if match:
+        # Ranked search results are sorted anyway; tags only filter them.
+        marks = ", ".join("?" for _ in tags)
+        sql += f"""
+        AND p.id IN (
+            SELECT it.item_id FROM item_tags it
+            JOIN tags t ON t.id = it.tag_id
+            WHERE t.name IN ({marks})
+        """
+        params.extend(tags)
+        if tag_mode == "all" and len(tags) > 1:
+            sql += " GROUP BY it.item_id HAVING COUNT(*) = ?"
+            params.append(len(tags))
+        sql += ")"
+        return [(sql, params)], order
 
-    rows = db.execute(sql, params).fetchall()
-    has_next = len(rows) > per_page
-    portfolios = rows[:per_page]
+    if tag_mode == "any" and len(tags) > 1:
+        return [(sql, [tag] + params) for tag in tags], order
 
-    # Distinct categories for filter
-    categories = db.execute(
-        "SELECT DISTINCT category FROM portfolio_items WHERE visibility='public' AND category IS NOT NULL AND category != '' ORDER BY category"
-    ).fetchall()
+    for _ in tags[1:]:
+        sql += """
+        AND EXISTS (
+            SELECT 1 FROM item_tags x
+            WHERE x.item_id = it.item_id AND x.tag_id = (SELECT id FROM tags WHERE name = ?)
+        )
+        """
+    return [(sql, [tags[0]] + params + list(tags[1:]))], order
+
+
+def rarest_tags_first(db, tags):
+    """`tags` ordered by how many public items carry them, fewest first."""
+    marks = ", ".join("?" for _ in tags)
+    counts = dict(
+        db.execute(f"SELECT tag, item_count FROM tag_facets WHERE tag IN ({marks})", tags).fetchall()
+    )
+    return sorted(tags, key=lambda tag: counts.get(tag, 0))
+
+
+# --- CONDITIONAL GET ---
+
+def not_modified(etag_parts, changed_at):
+    """Return a 304 response if the client's copy of this page is current.
+
+    etag_parts must cover all data the page shows; the endpoint, language and
+    viewer are added here. The validators are kept on g so the full response
+    gets them too. Pages with a pending flash message are never validated.
+
+    Last-Modified only has whole seconds, so it is left out while the data
+    last changed in the current second: another change in that same second
+    would otherwise pass an If-Modified-Since check. Once the second is over,
+    any later change is stamped with a later second.
+    """
+    if session.get("_flashes"):
+        return None
+    user = get_current_user()
+    parts = (request.endpoint, get_locale(), user["id"] if user else None) + tuple(etag_parts)
+    etag = hashlib.sha1(cache_key(*parts).encode("utf-8")).hexdigest()
+    last_modified = None
+    if changed_at < int(time.time()):
+        last_modified = datetime.fromtimestamp(changed_at, timezone.utc)
+    g.page_validators = (etag, last_modified, user is None)
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return app.response_class(status=304)
+
+
+@app.after_request
+def add_page_validators(response):
+    validators = g.pop("page_validators", None)
+    if validators is None or response.status_code not in (200, 304):
+        return response
+    etag, last_modified, anonymous = validators
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Anonymous pages are the same for everyone without a session cookie.
+    if anonymous and not session.modified:
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config["PUBLIC_PAGE_MAX_AGE"]
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+
+# --- ROUTES ---
+
+@app.route("/")
+def index():
+    db = get_read_db()
+    q = request.args.get("q", "").strip()
+    category = request.args.get("category", "").strip()
+    tags = parse_tags(",".join(request.args.getlist("tag")))
+    tag_mode = "any" if request.args.get("tag_mode") == "any" else "all"
+
+    walk_tags = tags
+    if tag_mode == "all" and len(tags) > 1:
+        walk_tags = rarest_tags_first(db, tags)
+    queries, order = feed_query(q, category, walk_tags, tag_mode)
+    after, before = page_cursors(order)
+    generation = get_data_generation(db)
+
+    unchanged = not_modified([generation], get_data_changed_at(db))
+    if unchanged is not None:
+        return unchanged
+
+    key = cache_key("feed_cards", generation, q.lower(), category, tags, tag_mode, after, before)
+    feed = feed_cache.get(key)
+    if feed is None:
+        page = union_keyset_page(db, queries, order, after=after, before=before)
+        feed = {
+            "items": listing(page.items, FeedCard),
+            "next_cursor": page.next_cursor,
+            "prev_cursor": page.prev_cursor,
+        }
+        feed_cache.set(key, feed)
+
+    key = cache_key("facets", generation)
+    facets = feed_cache.get(key)
+    if facets is None:
+        facets = load_facets(db)
+        feed_cache.set(key, facets)
 
     return render_template(
         "index.html",
-        portfolios=portfolios,
+        # The SQLite cache backend hands tuples back as plain lists.
+        portfolios=listing(feed["items"], FeedCard),
         q=q,
         category=category,
-        categories=categories,
-        page=page,
-        has_next=has_next,
+        tags=tags,
+        tag_mode=tag_mode,
+        categories=facets["categories"],
+        tag_facets=facets["tags"],
+        next_cursor=feed["next_cursor"],
+        prev_cursor=feed["prev_cursor"],
+        has_next=feed["next_cursor"] is not None,
     )
 
 
@@ -522,7 +3491,7 @@ def register():
         elif len(password) < 6:
             errors.append("Password must be at least 6 characters.")
 
-        db = get_db()
+        db = get_read_db()
         if username:
             existing = db.execute(
                 "SELECT id FROM users WHERE username = ?",
@@ -546,14 +3515,14 @@ def register():
         password_hash = generate_password_hash(password)
         created_at = datetime.utcnow().isoformat()
 
-        db.execute(
-            """
-            INSERT INTO users (full_name, username, email, password_hash, created_at)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (full_name, username, email, password_hash, created_at),
-        )
-        db.commit()
+        with write_transaction() as db:
+            db.execute(
+                """
+                INSERT INTO users (full_name, username, email, password_hash, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (full_name, username, email, password_hash, created_at, created_at),
+            )
 
         flash("Registration successful! You can now log in.", "success")
         return redirect(url_for("login"))
@@ -571,7 +3540,7 @@ def login():
         password = request.form.get("password", "")
         remember = request.form.get("remember") == "on"
 
-        db = get_db()
+        db = get_read_db()
         user = db.execute(
             "SELECT * FROM users WHERE username = ? OR email = ?",
             (username_or_email, username_or_email),
@@ -603,21 +3572,34 @@ def logout():
 @login_required
 def profile():
     user = get_current_user()
-    db = get_db()
-    portfolios = db.execute(
-        """
-        SELECT * FROM portfolio_items
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-        """,
+    db = get_read_db()
+    after, before = page_cursors(ITEMS_ORDER)
+    page = keyset_page(
+        db,
+        f"SELECT {OWNER_COLUMNS} FROM portfolio_items WHERE user_id = ?",
+        [user["id"]],
+        ITEMS_ORDER,
+        after=after,
+        before=before,
+        per_page=PROFILE_PER_PAGE,
+    )
+    item_count = db.execute(
+        "SELECT COUNT(*) FROM portfolio_items WHERE user_id = ?",
         (user["id"],),
-    ).fetchall()
-    return render_template("profile.html", user=user, portfolios=portfolios)
+    ).fetchone()[0]
+    return render_template(
+        "profile.html",
+        user=user,
+        portfolios=listing(page.items, OwnerCard),
+        item_count=item_count,
+        next_cursor=page.next_cursor,
+        prev_cursor=page.prev_cursor,
+    )
 
 
 @app.route("/u/<username>")
 def public_profile(username):
-    db = get_db()
+    db = get_read_db()
     user = db.execute(
         "SELECT * FROM users WHERE username = ?",
         (username.lower(),),
@@ -625,23 +3607,56 @@ def public_profile(username):
     if not user:
         abort(404)
 
-    portfolios = db.execute(
+    # One pass over the user's public items gives both the count shown on
+    # the page and a version for them (variants are filled in later, without
+    # touching updated_at).
+    item_count, items_updated_at, items_with_variants = db.execute(
         """
-        SELECT * FROM portfolio_items
-        WHERE user_id = ? AND visibility = 'public'
-        ORDER BY created_at DESC
+        SELECT COUNT(*), MAX(updated_at), COUNT(image_variants)
+        FROM portfolio_items WHERE user_id = ? AND visibility = 'public'
         """,
         (user["id"],),
-    ).fetchall()
+    ).fetchone()
+    unchanged = not_modified(
+        [
+            user["id"],
+            user["updated_at"],
+            user["avatar_filename"],
+            user["avatar_variants"] is not None,
+            item_count,
+            items_updated_at,
+            items_with_variants,
+        ],
+        get_data_changed_at(db),
+    )
+    if unchanged is not None:
+        return unchanged
+
+    after, before = page_cursors(ITEMS_ORDER)
+    page = keyset_page(
+        db,
+        f"SELECT {PUBLIC_COLUMNS} FROM portfolio_items WHERE user_id = ? AND visibility = 'public'",
+        [user["id"]],
+        ITEMS_ORDER,
+        after=after,
+        before=before,
+        per_page=PROFILE_PER_PAGE,
+    )
 
-    return render_template("public_profile.html", user=user, portfolios=portfolios)
+    return render_template(
+        "public_profile.html",
+        user=user,
+        portfolios=listing(page.items, PublicCard),
+        item_count=item_count,
+        next_cursor=page.next_cursor,
+        prev_cursor=page.prev_cursor,
+    )
 
 
 @app.route("/settings", methods=["GET", "POST"])
 @login_required
 def settings():
     user = get_current_user()
-    db = get_db()
 
     if request.method == "POST":
         full_name = request.form.get("full_name", "").strip()
@@ -657,33 +3672,56 @@ def settings():
             return render_template("settings.html", user=user)
 
         avatar_file = request.files.get("avatar")
-        avatar_filename = user["avatar_filename"]
+        new_avatar = None
         if avatar_file and avatar_file.filename:
             if not allowed_file(avatar_file.filename):
                 flash("Avatar must be an image file (jpg, jpeg, png, gif).", "danger")
                 return render_template("settings.html", user=user)
-            avatar_filename = save_uploaded_file(avatar_file)
+            new_avatar = save_uploaded_file(avatar_file)
+            if new_avatar is None:
+                flash("Avatar must be an image file (jpg, jpeg, png, gif).", "danger")
+                return render_template("settings.html", user=user)
 
-        db.execute(
-            """
-            UPDATE users
-            SET full_name = ?, bio = ?, location = ?, website = ?, linkedin = ?,
-                github = ?, profession = ?, avatar_filename = ?
-            WHERE id = ?
-            """,
-            (
-                full_name,
-                bio,
-                location,
-                website,
-                linkedin,
-                github,
-                profession,
-                avatar_filename,
-                user["id"],
-            ),
-        )
-        db.commit()
+        with write_transaction() as db:
+            # `user` may come from user_cache and be stale (another worker may
+            # have changed the avatar since), so writes start from the real row.
+            old = db.execute(
+                "SELECT avatar_filename, avatar_variants FROM users WHERE id = ?",
+                (user["id"],),
+            ).fetchone()
+            avatar_filename = old["avatar_filename"]
+            avatar_variants = old["avatar_variants"]
+            if new_avatar is not None and new_avatar != old["avatar_filename"]:
+                avatar_filename = new_avatar
+                avatar_variants = known_image_variants(db, avatar_filename, "avatar")
+                swap_upload(db, old["avatar_filename"], avatar_filename)
+            db.execute(
+                """
+                UPDATE users
+                SET full_name = ?, bio = ?, location = ?, website = ?, linkedin = ?,
+                    github = ?, profession = ?, avatar_filename = ?, avatar_variants = ?,
+                    updated_at = ?
+                WHERE id = ?
+                """,
+                (
+                    full_name,
+                    bio,
+                    location,
+                    website,
+                    linkedin,
+                    github,
+                    profession,
+                    avatar_filename,
+                    avatar_variants,
+                    datetime.utcnow().isoformat(),
+                    user["id"],
+                ),
+            )
+            if avatar_filename != old["avatar_filename"] and not avatar_variants:
+                schedule_image_variants(db, avatar_filename, "avatar")
+            reindex_user_items(db, user["id"])
+            bump_data_generation(db)
+        forget_current_user(user["id"])
         flash("Profile updated successfully.", "success")
         return redirect(url_for("settings"))
 
@@ -696,7 +3734,6 @@ def settings():
 @login_required
 def create_portfolio():
     user = get_current_user()
-    db = get_db()
 
     if request.method == "POST":
         title = request.form.get("title", "").strip()
@@ -720,30 +3757,49 @@ def create_portfolio():
                 flash("Portfolio image must be an image file (jpg, jpeg, png, gif).", "danger")
                 return render_template("create_portfolio.html", portfolio=None)
             image_filename = save_uploaded_file(image_file)
+            if image_filename is None:
+                flash("Portfolio image must be an image file (jpg, jpeg, png, gif).", "danger")
+                return render_template("create_portfolio.html", portfolio=None)
 
         now = datetime.utcnow().isoformat()
 
-        db.execute(
-            """
-            INSERT INTO portfolio_items
-            (user_id, title, description, category, tags, external_link,
-             image_filename, visibility, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                user["id"],
-                title,
-                description,
-                category,
-                tags,
-                external_link,
-                image_filename,
-                visibility,
-                now,
-                now,
-            ),
-        )
-        db.commit()
+        with write_transaction() as db:
+            image_variants = None
+            if image_filename:
+                image_variants = known_image_variants(db, image_filename, "item")
+                acquire_upload(db, image_filename)
+            cur = db.execute(
+                """
+                INSERT INTO portfolio_items
+                (user_id, title, description, description_excerpt, category, tags, external_link,
+                 image_filename, image_variants, visibility, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    user["id"],
+                    title,
+                    description,
+                    description_excerpt(description),
+                    category,
+                    tags,
+                    external_link,
+                    image_filename,
+                    image_variants,
+                    visibility,
+                    now,
+                    now,
+                ),
+            )
+            index_portfolio_item(db, cur.lastrowid)
+            set_item_tags(db, cur.lastrowid, tags)
+            update_facets(
+                db,
+                None,
+                {"visibility": visibility, "category": category, "tags": tags},
+            )
+            if not image_variants:
+                schedule_image_variants(db, image_filename, "item")
+            bump_data_generation(db)
         flash("Portfolio item created.", "success")
         return redirect(url_for("profile"))
 
@@ -754,7 +3810,7 @@ def create_portfolio():
 @login_required
 def edit_portfolio(item_id):
     user = get_current_user()
-    db = get_db()
+    db = get_read_db()
 
     portfolio = db.execute(
         "SELECT * FROM portfolio_items WHERE id = ? AND user_id = ?",
@@ -780,36 +3836,66 @@ def edit_portfolio(item_id):
             return render_template("create_portfolio.html", portfolio=portfolio)
 
         image_file = request.files.get("image")
-        image_filename = portfolio["image_filename"]
+        new_image = None
         if image_file and image_file.filename:
             if not allowed_file(image_file.filename):
                 flash("Portfolio image must be an image file (jpg, jpeg, png, gif).", "danger")
                 return render_template("create_portfolio.html", portfolio=portfolio)
-            image_filename = save_uploaded_file(image_file)
+            new_image = save_uploaded_file(image_file)
+            if new_image is None:
+                flash("Portfolio image must be an image file (jpg, jpeg, png, gif).", "danger")
+                return render_template("create_portfolio.html", portfolio=portfolio)
 
         now = datetime.utcnow().isoformat()
 
-        db.execute(
-            """
-            UPDATE portfolio_items
-            SET title = ?, description = ?, category = ?, tags = ?, external_link = ?,
-                image_filename = ?, visibility = ?, updated_at = ?
-            WHERE id = ? AND user_id = ?
-            """,
-            (
-                title,
-                description,
-                category,
-                tags,
-                external_link,
-                image_filename,
-                visibility,
-                now,
-                item_id,
-                user["id"],
-            ),
-        )
-        db.commit()
+        with write_transaction() as db:
+            old = db.execute(
+                "SELECT visibility, category, tags, image_filename, image_variants FROM portfolio_items WHERE id = ?",
+                (item_id,),
+            ).fetchone()
+            if old is None:
+                abort(404)
+            # The page row came from the read pool; keep whatever image the
+            # item has now unless a new one was uploaded.
+            image_filename, image_variants = old["image_filename"], old["image_variants"]
+            image_changed = new_image is not None and new_image != image_filename
+            if image_changed:
+                image_filename = new_image
+                image_variants = known_image_variants(db, image_filename, "item")
+                swap_upload(db, old["image_filename"], image_filename)
+            db.execute(
+                """
+                UPDATE portfolio_items
+                SET title = ?, description = ?, description_excerpt = ?, category = ?, tags = ?,
+                    external_link = ?, image_filename = ?, image_variants = ?, visibility = ?,
+                    updated_at = ?
+                WHERE id = ? AND user_id = ?
+                """,
+                (
+                    title,
+                    description,
+                    description_excerpt(description),
+                    category,
+                    tags,
+                    external_link,
+                    image_filename,
+                    image_variants,
+                    visibility,
+                    now,
+                    item_id,
+                    user["id"],
+                ),
+            )
+            index_portfolio_item(db, item_id)
+            set_item_tags(db, item_id, tags)
+            update_facets(
+                db,
+                old,
+                {"visibility": visibility, "category": category, "tags": tags},
+            )
+            if image_changed and not image_variants:
+                schedule_image_variants(db, image_filename, "item")
+            bump_data_generation(db)
         flash("Portfolio item updated.", "success")
         return redirect(url_for("profile"))
 
@@ -820,21 +3906,25 @@ def edit_portfolio(item_id):
 @login_required
 def delete_portfolio(item_id):
     user = get_current_user()
-    db = get_db()
 
-    portfolio = db.execute(
-        "SELECT * FROM portfolio_items WHERE id = ? AND user_id = ?",
-        (item_id, user["id"]),
-    ).fetchone()
-
-    if not portfolio:
-        abort(404)
-
-    db.execute(
-        "DELETE FROM portfolio_items WHERE id = ? AND user_id = ?",
-        (item_id, user["id"]),
-    )
-    db.commit()
+    # Ownership is checked inside the transaction, so it cannot race an edit.
+    with write_transaction() as db:
+        old = db.execute(
+            "SELECT visibility, category, tags, image_filename FROM portfolio_items WHERE id = ? AND user_id = ?",
+            (item_id, user["id"]),
+        ).fetchone()
+        if old is None:
+            abort(404)
+        if old["image_filename"]:
+            release_upload(db, old["image_filename"])
+        db.execute(
+            "DELETE FROM portfolio_items WHERE id = ? AND user_id = ?",
+            (item_id, user["id"]),
+        )
+        unindex_portfolio_item(db, item_id)
+        db.execute("DELETE FROM item_tags WHERE item_id = ?", (item_id,))
+        update_facets(db, old, None)
+        bump_data_generation(db)
     flash("Portfolio item deleted.", "info")
     return redirect(url_for("profile"))
 
@@ -851,6 +3941,18 @@ def server_error(e):
     return render_template("500.html"), 500
 
 
+@app.errorhandler(DatabaseBusy)
+def database_busy(e):
+    return render_template("500.html"), 503, {"Retry-After": "1"}
+
+
+@app.errorhandler(413)
+def request_too_large(e):
+    limit_mb = app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)
+    flash(f"Upload is too large (max {limit_mb} MB).", "danger")
+    return redirect(request.referrer or url_for("index"))
+
+
 @app.errorhandler(400)
 def bad_request(e):
     # Mostly CSRF errors here
@@ -860,9 +3962,63 @@ def bad_request(e):
 
 # --- STATIC UPLOADS ---
 
+def cache_upload_response(response):
+    max_age = app.config["UPLOADS_MAX_AGE"]
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    response.expires = datetime.utcnow() + timedelta(seconds=max_age)
+    return response
+
+
+def accel_upload_response(relative_path, etag):
+    """Empty response telling nginx to send the file itself (X-Accel-Redirect)."""
+    if etag is None:
+        stat = os.stat(os.path.join(app.config["UPLOAD_FOLDER"], relative_path))
+        etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    response = Response(mimetype=mimetypes.guess_type(relative_path)[0] or "application/octet-stream")
+    prefix = app.config["UPLOADS_ACCEL_PREFIX"].rstrip("/")
+    response.headers["X-Accel-Redirect"] = f"{prefix}/{quote(relative_path)}"
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
 @app.route("/uploads/<filename>")
 def uploaded_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    # The content hash is a perfect validator for content-addressed uploads,
+    # so a revalidation can be answered without touching the disk.
+    etag = upload_etag(filename)
+    if etag is not None and request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return cache_upload_response(response)
+
+    folder = app.config["UPLOAD_FOLDER"]
+    if secure_filename(filename) != filename:
+        abort(404)
+    path = locate_upload(filename)
+    if not os.path.isfile(path):
+        abort(404)
+    relative_path = os.path.relpath(path, folder).replace(os.sep, "/")
+
+    if app.config["UPLOADS_OFFLOAD"] == "x-accel":
+        response = accel_upload_response(relative_path, etag)
+    else:
+        # With USE_X_SENDFILE Flask adds the X-Sendfile header itself.
+        response = send_from_directory(
+            folder,
+            relative_path,
+            etag=etag or True,
+            max_age=app.config["UPLOADS_MAX_AGE"],
+        )
+    return cache_upload_response(response)
+
+
+# ❗ MUHIM: Flask 3 da before_first_request yo‘q, shuning uchun
+# app kontekstida init_db() ni modul yuklanganda bir marta chaqiramiz.
+# Migrations use helpers defined throughout this module, so this runs last.
+with app.app_context():
+    init_db()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+"""Test setup.
+
+Importing main opens and migrates DATABASE_PATH, so every path the app
+writes to is pointed at a scratch directory before anything imports it.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRATCH = tempfile.mkdtemp(prefix="portfohub-tests-")
+
+os.environ.update(
+    {
+        "DATABASE_PATH": os.path.join(SCRATCH, "database.db"),
+        "UPLOAD_FOLDER": os.path.join(SCRATCH, "uploads"),
+        "FEED_CACHE_PATH": os.path.join(SCRATCH, "cache.db"),
+        "METRICS_DIR": os.path.join(SCRATCH, "metrics"),
+        "SLOW_QUERY_LOG": os.path.join(SCRATCH, "slow_queries.jsonl"),
+        "PROFILE_DIR": os.path.join(SCRATCH, "profiles"),
+        "IMAGE_PIPELINE": "0",
+    }
+)
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+main.app.config["TESTING"] = True
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(SCRATCH, ignore_errors=True)
+
+
+@pytest.fixture
+def app():
+    return main.app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def csrf_token(client):
+    with client.session_transaction() as session:
+        return session.setdefault("csrf_token", "test-csrf-token")
+
+
+@pytest.fixture
+def author(client):
+    """A logged-in client for a fresh user; returns (client, username)."""
+    username = f"user{os.urandom(4).hex()}"
+    token = csrf_token(client)
+    response = client.post(
+        "/register",
+        data={
+            "csrf_token": token,
+            "full_name": "Test Author",
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "secret1",
+            "confirm_password": "secret1",
+        },
+    )
+    assert response.status_code == 302
+    response = client.post("/login", data={"csrf_token": token, "username": username, "password": "secret1"})
+    assert response.status_code == 302
+    return client, username
@@ -0,0 +1,130 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import main
+from conftest import ROOT
+
+LATEST = main.MIGRATIONS[-1][0]
+
+
+@pytest.fixture
+def baseline_db(tmp_path, monkeypatch):
+    """A copy of the shipped database.db (schema before any migration) with
+    a few extra rows in that old schema, opened as the app's database."""
+    path = str(tmp_path / "database.db")
+    shutil.copyfile(os.path.join(ROOT, "database.db"), path)
+    conn = sqlite3.connect(path)
+    user_id = conn.execute(
+        """
+        INSERT INTO users (full_name, username, email, password_hash, created_at)
+        VALUES ('Old Timer', 'oldtimer', 'old@example.com', 'x', '2023-05-01T00:00:00')
+        """
+    ).lastrowid
+    rows = [
+        ("Public one", "python, Flask ,python", "Code", "public", "word " * 100),
+        ("Public two", "flask", "Code", "public", ""),
+        ("Hidden", "python", "Design", "private", "secret"),
+    ]
+    for i, (title, tags, category, visibility, description) in enumerate(rows):
+        conn.execute(
+            """
+            INSERT INTO portfolio_items
+            (user_id, title, description, category, tags, visibility, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (user_id, title, description, category, tags, visibility, f"2023-06-0{i + 1}", f"2023-06-0{i + 1}"),
+        )
+    conn.commit()
+    conn.close()
+
+    # Point a fresh pool at the copy; init_db() runs the startup path on it.
+    # Cached feed pages are keyed by data generation, which both databases share.
+    monkeypatch.setattr(main, "DB_PATH", path)
+    monkeypatch.setattr(main, "_pools", {})
+    clear_caches()
+    with main.app.app_context():
+        yield path
+    for pool in main._pools.values():
+        while not pool._idle.empty():
+            pool._idle.get_nowait().close()
+    clear_caches()
+
+
+def clear_caches():
+    for cache in main.caches.values():
+        cache.clear()
+
+
+def test_scratch_database_is_at_the_latest_version(app):
+    with app.app_context():
+        assert main.current_schema_version(main.get_db()) == LATEST
+
+
+def test_baseline_upgrades_to_latest(baseline_db):
+    main.init_db()
+    db = main.get_db()
+    assert main.current_schema_version(db) == LATEST
+    assert [row[0] for row in db.execute("SELECT version FROM schema_version ORDER BY version")] == [
+        version for version, _, _ in main.MIGRATIONS
+    ]
+
+    items = {row["title"]: row for row in db.execute("SELECT * FROM portfolio_items")}
+    assert len(items) == 4  # the shipped item and three old-schema ones
+    assert items["Public one"]["description_excerpt"] == main.description_excerpt(items["Public one"]["description"])
+    assert items["Public two"]["description_excerpt"] == ""
+
+    tags = dict(
+        db.execute(
+            "SELECT p.title, GROUP_CONCAT(t.name) FROM item_tags it "
+            "JOIN tags t ON t.id = it.tag_id JOIN portfolio_items p ON p.id = it.item_id GROUP BY p.id"
+        ).fetchall()
+    )
+    assert sorted(tags["Public one"].split(",")) == ["flask", "python"]
+    # The sort key copied into item_tags matches the item.
+    assert not db.execute(
+        """
+        SELECT 1 FROM item_tags it JOIN portfolio_items p ON p.id = it.item_id
+        WHERE it.created_at IS NOT p.created_at OR it.visibility IS NOT p.visibility
+        """
+    ).fetchone()
+
+    # Facets count public items only.
+    facets = main.load_facets(db)
+    assert {"tag": "python", "item_count": 1} in facets["tags"]
+    assert {"tag": "flask", "item_count": 2} in facets["tags"]
+    assert {"category": "Design", "item_count": 0} not in facets["categories"]
+
+    if main.HAS_FTS5:
+        hits = db.execute(
+            "SELECT rowid FROM portfolio_search WHERE portfolio_search MATCH 'timer'"
+        ).fetchall()
+        assert len(hits) == 3
+
+
+def test_upgraded_baseline_serves_the_feed(baseline_db, client):
+    main.init_db()
+    html = client.get("/").get_data(as_text=True)
+    assert "Public one" in html and "Public two" in html and "Hidden" not in html
+    html = client.get("/", query_string={"tag": "python"}).get_data(as_text=True)
+    assert "Public one" in html and "Public two" not in html and "Hidden" not in html
+
+
+def test_upgrade_is_idempotent(baseline_db):
+    main.init_db()
+    db = main.get_db()
+    assert main.upgrade_db(db) == []
+    assert main.current_schema_version(db) == LATEST
+
+
+def test_stepwise_upgrade_matches_a_single_run(baseline_db):
+    db = main.get_db()
+    main.ensure_schema_version_table(db)
+    main.create_search_index(db)
+    db.commit()
+    for version, _, _ in main.MIGRATIONS:
+        assert main.upgrade_db(db, target=version) == [version]
+    assert main.current_schema_version(db) == LATEST
+    assert {"category": "Code", "item_count": 2} in main.load_facets(db)["categories"]
@@ -0,0 +1,217 @@
+import base64
+import json
+import re
+import sqlite3
+from html import unescape
+
+import pytest
+
+import main
+from conftest import csrf_token
+
+# (sql expression, row key, descending), like main.FEED_ORDER
+NEWEST_FIRST = [("created_at", "created_at", True), ("id", "id", True)]
+# Ascending score, then newest first: the shape of a bm25-ranked search
+RANKED = [("score", "score", False), ("created_at", "created_at", True), ("id", "id", True)]
+
+
+@pytest.fixture
+def db():
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, created_at TEXT, score REAL)")
+    conn.execute("CREATE TABLE item_tags (tag TEXT, item_id INTEGER)")
+    # Repeated timestamps and scores, so the id tiebreak matters.
+    for i in range(1, 24):
+        conn.execute(
+            "INSERT INTO items (id, created_at, score) VALUES (?, ?, ?)",
+            (i, f"2024-01-{i // 3 + 1:02d}", -float(i % 4)),
+        )
+        if i % 2 == 0:
+            conn.execute("INSERT INTO item_tags VALUES ('even', ?)", (i,))
+        if i % 3 == 0:
+            conn.execute("INSERT INTO item_tags VALUES ('three', ?)", (i,))
+    yield conn
+    conn.close()
+
+
+ALL_ITEMS = ("SELECT id, created_at, score FROM items WHERE 1", [])
+
+
+def tagged(tag):
+    return (
+        "SELECT i.id, i.created_at, i.score FROM item_tags t JOIN items i ON i.id = t.item_id WHERE t.tag = ?",
+        [tag],
+    )
+
+
+def expected_ids(db, order, queries=(ALL_ITEMS,)):
+    rows = {row["id"]: row for sql, params in queries for row in db.execute(sql, params)}
+    # Stable sorts from the last key to the first, each in its own direction.
+    result = list(rows.values())
+    for _, name, desc in reversed(order):
+        result.sort(key=lambda row: row[name], reverse=desc)
+    return [row["id"] for row in result]
+
+
+def walk(db, order, queries=(ALL_ITEMS,), per_page=4):
+    """Follow next cursors from the first page; returns the list of pages (lists of ids)."""
+    pages = []
+    after = None
+    while True:
+        page = main.union_keyset_page(db, list(queries), order, after=after, per_page=per_page)
+        pages.append((page, [row["id"] for row in page.items]))
+        if page.next_cursor is None:
+            return pages
+        after = main.decode_cursor(page.next_cursor, len(order))
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        ["2024-01-01T10:00:00", 7],
+        [-3.25, "2024-01-01", 12],
+        ["ünïcode ✓", 0],
+    ],
+)
+def test_cursor_round_trip(values):
+    token = main.encode_cursor(values)
+    assert "=" not in token
+    assert main.decode_cursor(token, len(values)) == values
+
+
+@pytest.mark.parametrize(
+    "token",
+    [
+        None,
+        "",
+        "!!!not base64!!!",
+        base64.urlsafe_b64encode(b"not json").decode(),
+        main.encode_cursor({"created_at": "x", "id": 1}),
+        main.encode_cursor(["only one"]),
+        main.encode_cursor(["2024-01-01", 1, 2]),
+        main.encode_cursor(["2024-01-01", True]),
+        main.encode_cursor(["2024-01-01", None]),
+        main.encode_cursor(["2024-01-01", [1]]),
+    ],
+)
+def test_malformed_cursor_is_ignored(token):
+    assert main.decode_cursor(token, 2) is None
+
+
+def test_same_direction_uses_row_value_comparison():
+    clause, params = main.keyset_condition(NEWEST_FIRST, ["2024-01-01", 5])
+    assert clause == "(created_at, id) < (?, ?)"
+    assert params == ["2024-01-01", 5]
+    clause, _ = main.keyset_condition(NEWEST_FIRST, ["2024-01-01", 5], backwards=True)
+    assert clause == "(created_at, id) > (?, ?)"
+
+
+@pytest.mark.parametrize("order", [NEWEST_FIRST, RANKED], ids=["newest", "ranked"])
+@pytest.mark.parametrize("per_page", [1, 4, 23, 50])
+def test_forward_walk_visits_every_row_once_in_order(db, order, per_page):
+    pages = walk(db, order, per_page=per_page)
+    ids = [item for _, page_ids in pages for item in page_ids]
+    assert ids == expected_ids(db, order)
+    first, _ = pages[0]
+    assert first.prev_cursor is None
+    last, last_ids = pages[-1]
+    assert last.next_cursor is None
+    # 23 rows split evenly never leave an empty trailing page.
+    assert last_ids
+
+
+@pytest.mark.parametrize("order", [NEWEST_FIRST, RANKED], ids=["newest", "ranked"])
+@pytest.mark.parametrize("per_page", [1, 4, 23])
+def test_back_pagination_returns_the_previous_page(db, order, per_page):
+    pages = walk(db, order, per_page=per_page)
+    for (previous, previous_ids), (current, _) in zip(pages, pages[1:]):
+        before = main.decode_cursor(current.prev_cursor, len(order))
+        back = main.union_keyset_page(db, [ALL_ITEMS], order, before=before, per_page=per_page)
+        assert [row["id"] for row in back.items] == previous_ids
+        assert back.next_cursor == previous.next_cursor
+        # Walking back onto the first page leaves nothing before it.
+        assert (back.prev_cursor is None) == (previous is pages[0][0])
+
+
+def test_back_pagination_from_the_first_row_is_empty(db):
+    first_id = expected_ids(db, NEWEST_FIRST)[0]
+    row = db.execute("SELECT created_at, id FROM items WHERE id = ?", (first_id,)).fetchone()
+    page = main.union_keyset_page(db, [ALL_ITEMS], NEWEST_FIRST, before=[row["created_at"], row["id"]], per_page=4)
+    assert page.items == []
+    assert page.next_cursor is None and page.prev_cursor is None
+
+
+def test_union_pages_dedupe_rows_found_by_several_queries(db):
+    queries = [tagged("even"), tagged("three")]
+    pages = walk(db, NEWEST_FIRST, queries, per_page=4)
+    ids = [item for _, page_ids in pages for item in page_ids]
+    assert len(ids) == len(set(ids))
+    assert ids == expected_ids(db, NEWEST_FIRST, queries)
+    # 6, 12 and 18 carry both tags.
+    assert {6, 12, 18} <= set(ids)
+
+
+def test_union_back_pagination_matches_forward_pages(db):
+    queries = [tagged("even"), tagged("three")]
+    pages = walk(db, NEWEST_FIRST, queries, per_page=3)
+    for (_, previous_ids), (current, _) in zip(pages, pages[1:]):
+        before = main.decode_cursor(current.prev_cursor, 2)
+        back = main.union_keyset_page(db, queries, NEWEST_FIRST, before=before, per_page=3)
+        assert [row["id"] for row in back.items] == previous_ids
+
+
+def test_union_pages_refuse_mixed_directions(db):
+    with pytest.raises(AssertionError):
+        main.union_keyset_page(db, [tagged("even"), tagged("three")], RANKED, per_page=3)
+
+
+def feed_titles(html):
+    return re.findall(r'<h5 class="card-title mb-\d">([^<]+)</h5>', html)
+
+
+def feed_link(html, label):
+    match = re.search(r'href="([^"]+)">' + label + "</a>", html)
+    return unescape(match.group(1)) if match else None
+
+
+def test_search_feed_pages_through_ranked_results(author):
+    client, username = author
+    marker = f"zq{username}"
+    for i in range(main.FEED_PER_PAGE * 2 + 3):
+        response = client.post(
+            "/portfolio/new",
+            data={
+                "csrf_token": csrf_token(client),
+                "title": f"{marker} item {i}",
+                "description": " ".join([marker] * (i % 4 + 1)),
+                "tags": f"{marker}tag",
+                "visibility": "public",
+            },
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 302
+
+    for url in (f"/?q={marker}", f"/?tag={marker}tag"):
+        seen = []
+        pages = []
+        while url:
+            html = client.get(url).get_data(as_text=True)
+            pages.append(feed_titles(html))
+            seen += pages[-1]
+            url = feed_link(html, "Next")
+        assert len(seen) == len(set(seen)) == main.FEED_PER_PAGE * 2 + 3
+
+        # And back again from the last page.
+        url = feed_link(html, "Previous")
+        for expected in reversed(pages[:-1]):
+            html = client.get(url).get_data(as_text=True)
+            assert feed_titles(html) == expected
+            url = feed_link(html, "Previous")
+        assert url is None
+
+
+@pytest.mark.parametrize("cursor", ["garbage", main.encode_cursor(["x"]), main.encode_cursor([1.5, "x", True])])
+def test_feed_ignores_malformed_cursors(client, cursor):
+    assert client.get("/", query_string={"after": cursor}).status_code == 200
+    assert client.get("/", query_string={"q": "java", "before": cursor}).status_code == 200